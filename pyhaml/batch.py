@@ -0,0 +1,169 @@
+"""
+Batch compiles Haml files ahead of rendering, writing the code of each to its
+.pyc file, and to the ir_cache directory if there is one.  Files are compiled
+in a pool of processes.  A manifest file records the hash of the source and
+options each file was compiled with, and of the files linked into it, so that
+the next batch only compiles the files that changed since.  Unless another
+one is given, the manifest is kept in the __pycache__ directory of the
+directory holding all the files.  On Python 2.5, files are compiled one after
+another, and without simplejson no manifest is kept.
+"""
+from __future__ import with_statement
+
+import os
+import hashlib
+import logging
+import traceback
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+import bundle
+import blocks
+from haml import Engine, Loader, HamlException
+from loaders import atomic_write
+from patch import json, dont_write_bytecode
+
+#the Engine of each process compiling files
+engine = None
+
+def templates(paths):
+    """
+Returns the Haml files among paths and in the directory trees among them.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name)
+                for name in bundle.templates(path))
+        elif path.endswith('.haml'):
+            files.append(path)
+    return files
+
+def digest(source, options, linked=()):
+    """
+Returns the hash of a Haml file's source, the options it compiles with and the
+fingerprints of the files linked into it.
+    """
+    return hashlib.md5(repr((source, options, list(linked)))).hexdigest()
+
+def entry(engine, source, linked):
+    """
+Returns the manifest entry of a Haml file: its digest and the paths of the
+files linked into it, given those paths.
+    """
+    linked = sorted(linked)
+    return [digest(source, engine._options(),
+        [engine.loader.fingerprint(p) for p in linked]), linked]
+
+def compile_file(args):
+    """
+Compiles a Haml file and writes its code out.  Returns (path, manifest entry,
+error), where the entry is None and error a message if the file could not be
+compiled.  Any exception fails only its file, so that a batch reports every
+failure; those that are not HamlExceptions are reported with their traceback.
+    """
+    global engine
+    (path, options) = args
+    if engine is None:
+        engine = Engine()
+    engine.setops(**options)
+    try:
+        source = engine.loader.get_source(path)
+        #the code cached from an earlier batch may have other options
+        engine.invalidate(path)
+        code = engine.cache(path)
+        #the engine only writes .pyc files if bytecode may be written
+        if dont_write_bytecode():
+            Loader(engine, path).write_code(code)
+        return (path, entry(engine, source, blocks.linked(code)), None)
+    except (HamlException, IOError, OSError), ex:
+        return (path, None, str(ex))
+    except Exception:
+        return (path, None, traceback.format_exc())
+
+def load_manifest(path):
+    """Returns the entries a manifest file records by file, or none."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def default_manifest(paths):
+    """
+Returns the manifest file of a batch of Haml files when none is given, in the
+__pycache__ directory of the directory holding all of them.
+    """
+    dirs = [os.path.dirname(os.path.abspath(path)).split(os.sep)
+        for path in paths]
+    root = os.sep.join(os.path.commonprefix(dirs)) or os.sep
+    return os.path.join(root, '__pycache__', 'haml-manifest.json')
+
+def save_manifest(path, manifest):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with atomic_write(path, 'w') as f:
+        json.dump(manifest, f, indent=0, sort_keys=True)
+
+def run(paths, options, manifest=None, jobs=0):
+    """
+Compiles Haml files with the given options, in jobs processes or one per CPU.
+Files whose source and options are unchanged since the batch that wrote the
+manifest file, and whose .pyc files are still there, are skipped.  The
+manifest file is the default_manifest of the files if it is None.  Returns the
+pairs (path, error) of the files that could not be compiled.
+    """
+    eng = Engine()
+    eng.setops(**options)
+    if json is None:
+        manifest = None
+    elif manifest is None and paths:
+        manifest = default_manifest(paths)
+    recorded = manifest and load_manifest(manifest) or {}
+    todo = []
+    for path in paths:
+        key = os.path.abspath(path)
+        try:
+            source = eng.loader.get_source(path)
+        except IOError:
+            source = None
+        old = recorded.get(key)
+        if source is not None and isinstance(old, list) and len(old) == 2 and \
+           old == entry(eng, source, old[1]) and \
+           os.path.isfile(Loader(eng, path).cache_path()):
+            continue
+        recorded.pop(key, None)
+        todo.append((path, options))
+    if multiprocessing is None:
+        jobs = 1
+    jobs = jobs or multiprocessing.cpu_count()
+    if jobs > 1 and len(todo) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(todo)))
+        try:
+            results = pool.map(compile_file, todo)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(compile_file, todo)
+    errors = []
+    for (path, value, error) in results:
+        if error is None:
+            recorded[os.path.abspath(path)] = value
+        else:
+            errors.append((path, error))
+    if manifest:
+        try:
+            save_manifest(manifest, recorded)
+        except (IOError, OSError):
+            logging.exception("could not write %s:", manifest)
+    return errors
+
+def report(errors):
+    """Returns a report of the files a batch could not compile."""
+    lines = ['%d haml file(s) failed to compile:\n' % len(errors)]
+    for (path, error) in errors:
+        lines.append('\n%s:\n%s\n' % (path, error.rstrip()))
+    return ''.join(lines)
@@ -0,0 +1,159 @@
+import re
+import dis
+import types
+from array import array
+
+#silent scripts continuing the Python statement of the block before them
+continuation = re.compile(r'-[ \t]*(else|elif|except|finally)\b')
+
+def starts_block(line, last):
+    """
+Returns whether a line at column zero starts a new top-level block, given the
+last non-blank line before it.
+    """
+    if line[:1] in ('', ' ', '\t', '\r', '\n'):
+        return False
+    last = last.rstrip()
+    #multiline values, backslash continuations and Python decorators all
+    #carry on into the next line
+    if last.endswith('|') or last.endswith('\\'):
+        return False
+    if last[:1] == '-' and last[1:].lstrip()[:1] == '@':
+        return False
+    return not continuation.match(line)
+
+def split(s):
+    """
+Splits Haml source into top-level blocks: a line at column zero followed by
+the indented and blank lines after it.  Returns a list of pairs (line number of
+the first line, text), whose texts add up to s.
+    """
+    blocks = []
+    start = 0
+    start_lineno = lineno = 1
+    last = ''
+    pos = 0
+    while pos < len(s):
+        end = s.find('\n', pos)
+        if end == -1:
+            end = len(s)
+        else:
+            end += 1
+        line = s[pos:end]
+        if last and starts_block(line, last):
+            blocks.append((start_lineno, s[start:pos]))
+            start = pos
+            start_lineno = lineno
+            last = ''
+        if line.strip():
+            last = line
+        lineno += 1
+        pos = end
+    blocks.append((start_lineno, s[start:]))
+    return blocks
+
+def relocate(code, filename, offset):
+    """
+Returns a copy of a code object and the code objects it contains, with the
+given file name and line numbers moved down by offset.  Code objects of other
+files, such as those embedded by linking, are left as they are.
+    """
+    consts = tuple(
+        isinstance(c, types.CodeType) and c.co_filename == code.co_filename
+        and relocate(c, filename, offset) or c
+        for c in code.co_consts)
+    return types.CodeType(code.co_argcount, code.co_nlocals,
+        code.co_stacksize, code.co_flags, code.co_code, consts,
+        code.co_names, code.co_varnames, filename, code.co_name,
+        code.co_firstlineno + offset, code.co_lnotab, code.co_freevars,
+        code.co_cellvars)
+
+def renumber(code, lines):
+    """
+Returns a copy of a code object and the code objects it contains, with each
+line number n changed to lines[n], if there is one.  Line tables can only step
+forward, so lines must never decrease.  Code objects of other files are left
+as they are.
+    """
+    consts = tuple(
+        isinstance(c, types.CodeType) and c.co_filename == code.co_filename
+        and renumber(c, lines) or c
+        for c in code.co_consts)
+    line_of = lambda n: n < len(lines) and lines[n] or n
+    firstlineno = line_of(code.co_firstlineno)
+    #the line table is pairs of (bytecode offset, line) increments of at most
+    #255 each, written the way the compiler writes them
+    lnotab = array('B')
+    (last_offset, last_line) = (0, firstlineno)
+    for (offset, line) in dis.findlinestarts(code):
+        line = line_of(line)
+        if line <= last_line:
+            continue
+        (skip, count) = (offset - last_offset, line - last_line)
+        while skip > 255:
+            lnotab.extend((255, 0))
+            skip -= 255
+        while count > 255:
+            lnotab.extend((skip, 255))
+            (skip, count) = (0, count - 255)
+        lnotab.extend((skip, count))
+        (last_offset, last_line) = (offset, line)
+    return types.CodeType(code.co_argcount, code.co_nlocals,
+        code.co_stacksize, code.co_flags, code.co_code, consts,
+        code.co_names, code.co_varnames, code.co_filename, code.co_name,
+        firstlineno, lnotab.tostring(), code.co_freevars, code.co_cellvars)
+
+def link(blocks, filename):
+    """
+Returns a code object that runs the code of each block in turn, in the globals
+it is run in.  blocks is a list of pairs (line number of the first line, code).
+Each block is run from its first line, so tracebacks show where it starts.
+    """
+    lines = []
+    for i, (lineno, code) in enumerate(blocks):
+        lines += [''] * (lineno - 1 - len(lines))
+        lines.append('exec(%d)' % i)
+    #compile runs exec on placeholder numbers, which are then swapped for the
+    #code of the blocks.  exec(code) in the globals and locals of the caller
+    #is both a statement in Python 2 and a call in Python 3.
+    wrapper = compile('\n'.join(lines) + '\n', filename, 'exec')
+    consts = tuple(
+        type(c) is int and blocks[c][1] or c
+        for c in wrapper.co_consts)
+    return types.CodeType(wrapper.co_argcount, wrapper.co_nlocals,
+        wrapper.co_stacksize, wrapper.co_flags, wrapper.co_code, consts,
+        wrapper.co_names, wrapper.co_varnames, filename, wrapper.co_name,
+        wrapper.co_firstlineno, wrapper.co_lnotab, wrapper.co_freevars,
+        wrapper.co_cellvars)
+
+def embed(code, values):
+    """
+Returns a copy of a code object and the code objects it contains, with the
+string constants that are keys of values replaced by their values.
+    """
+    consts = tuple(
+        isinstance(c, types.CodeType) and embed(c, values) or
+        type(c) is str and values.get(c, c) or c
+        for c in code.co_consts)
+    return types.CodeType(code.co_argcount, code.co_nlocals,
+        code.co_stacksize, code.co_flags, code.co_code, consts,
+        code.co_names, code.co_varnames, code.co_filename, code.co_name,
+        code.co_firstlineno, code.co_lnotab, code.co_freevars,
+        code.co_cellvars)
+
+def linked(code):
+    """
+Returns the file names of the code objects of other files embedded in a code
+object, such as those of linked files, and in those in turn.
+    """
+    names = set()
+    codes = [code]
+    while codes:
+        parent = codes.pop()
+        for c in parent.co_consts:
+            if isinstance(c, types.CodeType):
+                if c.co_filename != parent.co_filename:
+                    names.add(c.co_filename)
+                codes.append(c)
+    names.discard(code.co_filename)
+    return names
@@ -0,0 +1,110 @@
+"""
+Bundles: a whole tree of Haml templates compiled into one file, so that an
+Engine can render them without reading, stat-ing, lexing or parsing any of
+them.  A bundle file is laid out as
+
+    'HAMLB' and the interpreter's magic number
+    the marshalled code object of each template, one after another
+    the marshalled index
+    the offset of the index, as 8 bytes
+
+The index holds the options the templates were compiled with, and for each
+template the position of its code, a fingerprint of its source, its line map
+and the templates it imports.  A Bundle maps the file once and only unmarshals
+the code of a template when it is first rendered.
+"""
+from __future__ import with_statement
+
+import os
+import imp
+import mmap
+import struct
+import marshal
+import hashlib
+from array import array
+
+from linemap import LineMap
+from loaders import TemplateLoader, normalize, children, atomic_write
+
+magic = 'HAMLB' + imp.get_magic()
+trailer = struct.Struct('<Q')
+
+def templates(root):
+    """Returns the names of the Haml files in a directory tree, relative to it."""
+    names = []
+    for (dir, dirs, files) in os.walk(root):
+        dirs[:] = sorted(d for d in dirs if d != '__pycache__')
+        rel = dir[len(root):].lstrip(os.sep)
+        for f in sorted(files):
+            if f.endswith('.haml'):
+                names.append(normalize(os.path.join(rel, f)))
+    return names
+
+def build(engine, names, path):
+    """
+Compiles the templates of an engine's loader into a bundle file.  names are
+the names of the templates, such as those returned by templates.
+    """
+    index = {}
+    with atomic_write(path) as f:
+        f.write(magic)
+        for name in names:
+            code = engine.cache(name)
+            start = f.tell()
+            marshal.dump(code, f)
+            source = engine.loader.get_source(name)
+            deps = tuple(sorted(normalize(dep)
+                for dep in engine.dependencies(name)))
+            index[name] = (start, f.tell(), hashlib.md5(source).hexdigest(),
+                engine._linemaps[code].lines.tostring(), deps)
+        start = f.tell()
+        marshal.dump({'options': repr(engine._options()),
+            'templates': index}, f)
+        f.write(trailer.pack(start))
+
+class Bundle(TemplateLoader):
+    """
+A template loader reading compiled templates from a bundle file.  There is no
+source in a bundle, so Engines compile nothing with it: they take the code of
+each template from the bundle instead.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(magic)] != magic:
+            raise IOError('%s is not a bundle for this interpreter' % path)
+        (start,) = trailer.unpack(self.map[-trailer.size:])
+        index = marshal.loads(self.map[start:-trailer.size])
+        self.options = index['options']
+        self.index = index['templates']
+
+    def get_source(self, name):
+        raise IOError('the source of %s is not in %s' % (name, self.path))
+
+    def fingerprint(self, name):
+        entry = self.index.get(normalize(name))
+        return entry and entry[2]
+
+    def listdir(self, dir):
+        return children(self.index, normalize(dir))
+
+    def load(self, name, options):
+        """
+Returns the code of a template, its LineMap and the names of the templates it
+imports.  Raises IOError if the template is not in the bundle, or if the
+bundle was compiled with other options.
+        """
+        entry = self.index.get(normalize(name))
+        if entry is None:
+            raise IOError('%s is not in %s' % (name, self.path))
+        if repr(options) != self.options:
+            raise IOError('%s was compiled with other options: %s' %
+                (self.path, self.options))
+        (start, end, _, lines, deps) = entry
+        code = marshal.loads(self.map[start:end])
+        linemap = LineMap(code.co_filename)
+        linemap.lines = array('i')
+        linemap.lines.fromstring(lines)
+        return code, linemap, deps
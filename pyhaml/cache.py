@@ -1,17 +1,36 @@
 import os
 
+def mtime(key):
+    """Fingerprints a file by its modification time, or None if it is missing."""
+    if not os.path.isfile(key):
+        return None
+    return os.path.getmtime(key)
+
 class Cache(object):
+    """
+Caches a value per file, such as its compiled code, for as long as the file is
+not modified.  The cache also keeps a graph of which files import which, so
+that a file is invalidated along with every file depending on it.  Whether a
+file was modified is told by a fingerprint function, such as a template
+loader's, which returns None for files that do not exist.
+    """
     
-    def __init__(self):
+    def __init__(self, fingerprint=mtime):
+        self.fingerprint = fingerprint
         self.cache = {}
+        #files each file imports, and files importing each file
+        self.imports = {}
+        self.importers = {}
+        #called with the set of files whose values are invalidated
+        self.on_invalidate = None
     
     def __contains__(self, key):
-        if not os.path.isfile(key) or not key in self.cache:
+        if not key in self.cache:
             return False
         
         (k,_) = self.cache[key]
-        if k < os.path.getmtime(key):
-            del self.cache[key]
+        if k != self.fingerprint(key):
+            self.invalidate(key)
             return False
         
         return True
@@ -24,7 +43,60 @@ class Cache(object):
         return v
     
     def __setitem__(self, key, val):
-        if not os.path.isfile(key):
+        k = self.fingerprint(key)
+        if k is None:
             raise IOError('invalid file path: ' + key)
         
-        self.cache[key] = (os.path.getmtime(key), val)
+        self.cache[key] = (k, val)
+    
+    def depend(self, key, imports):
+        """Records the files that the file key imports."""
+        for dep in self.imports.get(key, ()):
+            self.importers[dep].discard(key)
+        self.imports[key] = set(imports)
+        for dep in imports:
+            self.importers.setdefault(dep, set()).add(key)
+    
+    def dependents(self, key):
+        """Returns every file importing key, directly or through other files."""
+        result = set()
+        todo = [key]
+        while todo:
+            for k in self.importers.get(todo.pop(), ()):
+                if not k in result:
+                    result.add(k)
+                    todo.append(k)
+        result.discard(key)
+        return result
+    
+    def fresh(self, key, seen=None):
+        """
+Returns whether key is cached and up to date, and so is every cached file it
+imports, directly or not.  Stale files are invalidated on the way.
+        """
+        if seen is None:
+            seen = set()
+        seen.add(key)
+        if not key in self:
+            return False
+        for dep in self.imports.get(key, ()):
+            if dep in self.cache and not dep in seen and \
+               not self.fresh(dep, seen):
+                return False
+        return True
+    
+    def invalidate(self, key=None):
+        """
+Forgets the value of key and of every file depending on it, or every value if
+key is None.  Returns the files whose values were forgotten.
+        """
+        if key is None:
+            stale = set(self.cache)
+        else:
+            stale = self.dependents(key)
+            stale.add(key)
+        for k in stale:
+            self.cache.pop(k, None)
+        if self.on_invalidate is not None:
+            self.on_invalidate(stale)
+        return stale
@@ -3,31 +3,62 @@ from __future__ import with_statement
 
 import os
 import imp
+import copy
 import cgi
 import sys
 import re
-import code
+import tokenize
 from optparse import OptionParser
 import logging
 import traceback
+import types
+import weakref
+import threading
+import marshal
+import hashlib
 
 import lexer
 import parser
+import linelexer
+import lineparser
+import ir
+import blocks
 from lexer import HamlParserException
 from parser import get_lines_in_position_range
 from ply import lex, yacc
-from patch import ex, StringIO
+from patch import ex, StringIO, json, dont_write_bytecode
 from cache import Cache
+from linemap import LineMap
+from index import TemplateIndex
+from loaders import FileSystemLoader, atomic_write, normalize
+from bundle import Bundle
+from registry import HamlModule, ModuleRegistry, reusable
+import bundle
 
 __version__ = '0.1'
 
+#static imports in Haml source: _haml.imp('name') calls, and silent script lines
+#importing modules
+imp_call = re.compile(r"""_haml\.imp\(\s*(['"])([^'"\n]+)\1\s*\)""")
+import_line = re.compile(
+    r'^[ \t]*-[ \t]*(?:import[ \t]+([\w \t,]+)|from[ \t]+(\w+)[ \t]+import)',
+    re.M)
+
 class HamlException(Exception):
     """
-An exception thrown while parsing or rendering Haml.
+An exception thrown while parsing or rendering Haml.  Exceptions raised by a
+compile carry the Diagnostics found by the compile before it failed.
     """
-    pass
+
+    diagnostics = ()
 
 class Loader(object):
+    """
+A PEP 302 loader for a Haml file, read through the engine's template loader.
+The compiled code of a file on disk is kept in a .pyc file in a __pycache__
+directory next to it, which the engine uses for as long as the file, the files
+linked into it and the options stay the same.
+    """
 
     def __init__(self, engine, path):
         self.engine = engine
@@ -36,13 +67,121 @@ class Loader(object):
     def load_module(self, fullname):
         return self.engine.load_module(fullname, self.path, self)
 
+    def get_filename(self, fullname):
+        return self.path
+
+    def get_source(self, fullname):
+        return self.engine.loader.get_source(self.path)
+
+    def cache_path(self):
+        """
+Returns the path of the .pyc file for the Haml file, or None if the file is not
+read from disk.
+        """
+        loader = self.engine.loader
+        if not isinstance(loader, FileSystemLoader):
+            return None
+        (dir, name) = os.path.split(loader.path(self.path))
+        return os.path.join(dir, '__pycache__', name + '.pyc')
+
+    def get_code(self, fullname):
+        """
+Returns the code of the Haml file, from the engine's cache, the .pyc file or
+by compiling it, in that order.
+        """
+        return self.engine.cache(self.path)
+
+    def read_code(self):
+        """
+Returns the code kept in the .pyc file of the Haml file, or None if there is
+none for the current versions of the file and of the files linked into it, and
+the engine's options.
+        """
+        pyc = self.cache_path()
+        if pyc is None:
+            return None
+        header = self.header()
+        fingerprint = self.engine.loader.fingerprint
+        try:
+            with open(pyc, 'rb') as f:
+                if f.read(len(header)) == header:
+                    linked = marshal.load(f)
+                    if not [path for (path, fp) in linked
+                            if fingerprint(path) != fp]:
+                        return marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            pass
+        return None
+
+    def header(self):
+        """
+Returns the header of the .pyc file: the interpreter's magic number and a hash
+of the Haml file's fingerprint and the options, as 4 and 16 bytes.  The header
+is followed by the linked files of the code, as marshalled by write_code.
+        """
+        engine = self.engine
+        return imp.get_magic() + hashlib.md5(repr((
+            engine.loader.fingerprint(self.path), engine._options()))).digest()
+
+    def linked(self, code):
+        """
+Returns the files linked into the code of the Haml file, as a sorted list of
+pairs (path, fingerprint).
+        """
+        fingerprint = self.engine.loader.fingerprint
+        return [(path, fingerprint(path))
+            for path in sorted(blocks.linked(code))]
+
+    def write_code(self, code):
+        """Writes the compiled code of the Haml file to its .pyc file."""
+        pyc = self.cache_path()
+        if not os.path.isdir(os.path.dirname(pyc)):
+            os.makedirs(os.path.dirname(pyc))
+        with atomic_write(pyc) as f:
+            f.write(self.header())
+            marshal.dump(self.linked(code), f)
+            marshal.dump(code, f)
+
 class Finder(object):
+    """
+A PEP 302 finder for sys.meta_path, so that the import statement finds Haml
+files the way _haml.imp does while an engine renders.  There is one finder,
+installed by the first render, which asks the engine rendering in the current
+thread, so that engines rendering in other threads do not answer for it.
+    """
 
-    def __init__(self, engine):
-        self.engine = engine
+    def __init__(self):
+        #the engines rendering in each thread, innermost last
+        self.local = threading.local()
+
+    def install(self):
+        if not self in sys.meta_path:
+            imp.acquire_lock()
+            try:
+                if not self in sys.meta_path:
+                    sys.meta_path.append(self)
+            finally:
+                imp.release_lock()
+
+    def engines(self):
+        """Returns the engines rendering in the current thread."""
+        try:
+            return self.local.engines
+        except AttributeError:
+            self.local.engines = []
+            return self.local.engines
 
     def find_module(self, fullname, path=None):
-        return self.engine.find_module(fullname)
+        #only modules outside of packages can be Haml files
+        engines = self.engines()
+        if not engines or path is not None or '.' in fullname:
+            return None
+        try:
+            return engines[-1].find_module(fullname)
+        except ImportError:
+            return None
+
+finder = Finder()
 
 class Engine(object):
 
@@ -121,21 +260,138 @@ class Engine(object):
       dest='fail_fast',
       default=False)
 
+    optparser.add_option('-l', '--lexer',
+        help='lexer backend (ply|line)',
+        type='choice',
+        choices=['ply', 'line'],
+        dest='lexer',
+        default='ply')
+
+    optparser.add_option('-r', '--parser',
+        help='parser backend (ply|line)',
+        type='choice',
+        choices=['ply', 'line'],
+        dest='parser',
+        default='ply')
+
+    optparser.add_option('-O', '--optimize',
+        help='optimization profile (%s)' % '|'.join(sorted(ir.profiles)),
+        type='choice',
+        choices=sorted(ir.profiles),
+        dest='optimize',
+        default='default')
+
+    optparser.add_option('-n', '--incremental',
+        help='only recompile the top-level blocks that changed',
+        action='store_true',
+        dest='incremental',
+        default=False)
+
+    optparser.add_option('-k', '--link',
+        help='embed the code of files imported with _haml.imp by a fixed name '
+            'into the files importing them',
+        action='store_true',
+        dest='link',
+        default=False)
+
+    optparser.add_option('-S', '--search_path',
+        help='directories to find imported files in, separated by %s' %
+            os.pathsep,
+        dest='search_path',
+        default='')
+
+    optparser.add_option('-R', '--revalidate',
+        help='seconds before the files in the search path are looked up again',
+        type='float',
+        dest='revalidate',
+        default=1.0)
+
+    optparser.add_option('-c', '--ir_cache',
+        help='directory to keep the intermediate code of compiled files in, '
+            'which is read when there is no .pyc file',
+        dest='ir_cache',
+        default=None)
+
+    optparser.add_option('-j', '--jobs',
+        help='processes to batch compile haml files in, by default one per CPU',
+        type='int',
+        dest='jobs',
+        default=0)
+
+    optparser.add_option('-m', '--manifest',
+        help='file recording the haml files batch compiled, which are skipped '
+            'until they or the options change',
+        dest='manifest',
+        default=None)
+
+    optparser.add_option('-o', '--bundle',
+        help='bundle file to compile a directory of haml files into with '
+            '--batch, or to render them from',
+        dest='bundle',
+        default=None)
 
-    def __init__(self):
-        self._cache = Cache()
-        self.haml_line_cache = {}
-        self.parser = yacc.yacc(
-            module=parser,
-            write_tables=0,
-            debug=0)
-        self.lexer = lex.lex(module=lexer)
+
+    #options that do not change the code generated for a template
+    runtime_options = ('filename', 'debug', 'batch', 'lexer', 'parser',
+        'incremental', 'ir_cache', 'search_path', 'revalidate', 'bundle',
+        'jobs', 'manifest')
+
+    #the LALR tables and the lexer's regular expressions never change, so they
+    #are built by the first Engine and shared by all of them
+    _tables = None
+
+    def __init__(self, loader=None, max_modules=128):
+        #where templates are read from, by default files
+        self.loader = loader or FileSystemLoader()
+        self._cache = Cache(lambda path: self.loader.fingerprint(path))
+        self._cache.on_invalidate = self._forget
+        #line maps live exactly as long as the code objects they describe;
+        #the latest one of each file name can also be found by the name
+        self._linemaps = weakref.WeakKeyDictionary()
+        self._named_linemaps = weakref.WeakValueDictionary()
+        if Engine._tables is None:
+            Engine._tables = (
+                yacc.yacc(module=parser, write_tables=0, debug=0),
+                lex.lex(module=lexer))
+        #every Engine parses with its own copies, which hold the state of a
+        #parse and the options it runs with
+        self.parser = copy.copy(Engine._tables[0])
+        self.lexer = Engine._tables[1].clone()
+        self.lexer.lexstatestack = []
+        self.line_lexer = linelexer.LineLexer()
+        self.line_parser = lineparser.LineParser()
+        #seconds taken by each optimization pass in the last compile
+        self.timings = {}
+        #compiled top-level blocks of each file, for incremental compiles.
+        #Those of a file whose code went stale are kept until it is compiled
+        #again, since that is when they are reused.
+        self._blocks = {}
+        #Diagnostics found by the last compile
+        self.diagnostics = []
+        #imported Haml modules that can be reused, kept out of sys.modules
+        self._modules = ModuleRegistry(max_modules)
+        #modules being run, so that circular imports get the one being run
+        self._loading = {}
+        #files being compiled to be linked, which can not be linked again
+        self._linking = set()
+        #where imported names were found
+        self._index = TemplateIndex(
+            listdir=lambda dir: self.loader.listdir(dir))
+        self.lexer.op = None
+        self.lexer.diagnostics = []
+        self.reset()
 
     def reset(self):
         self.depth = 0
         self.html = StringIO()
         self.trim_next = False
         self.globals = { '_haml': self }
+        #what imported modules are handed: _haml and the render's arguments,
+        #but not the names the rendered template defines
+        self.context = dict(self.globals)
+        #the modules imported by the template being rendered, and by each
+        #module being run, innermost last
+        self._imported = [[]]
 
     def setops(self, *args, **kwargs):
         """
@@ -144,41 +400,169 @@ Sets options for the Haml engine.  Options should be given as keyword arguments.
         (self.op, _) = Engine.optparser.parse_args([])
         for (k,v) in kwargs.items():
             opt = Engine.optparser.get_option('--' + k)
-            if opt:
+            if opt and opt.type == 'int' and isinstance(v, int):
+                #optparse only converts strings to numbers
+                self.op.__dict__[k] = v
+            elif opt:
                 self.op.__dict__[k] = opt.check_value(k,v)
 
+    def _options(self):
+        """
+Returns the options that change the code generated for a template, as a
+sorted list of pairs.
+        """
+        return [(k, v) for (k, v) in sorted(self.op.__dict__.items())
+            if not k in Engine.runtime_options]
+
     def _modulename(self, path):
       """ensure no . characters exist in path, as these have meaning in g3"""
       return path.replace(".", "-dot-")
 
-    def find_module(self, fullname):
-        if not fullname.startswith("//"):
-          dir = os.path.dirname(self.op.filename)
-        else:
-          dir = os.curdir
-          fullname = fullname[2:]
-        path = os.path.join(dir, '%s.haml' % fullname)
-        if os.path.exists(path):
-            return Loader(self, path)
-        raise ImportError, "could not find file at path %s" % path
-
-    def load_module(self, fullname, path, loader):
-        code = self.cache(path)
+    def find_module(self, fullname, relative_to=None):
+        """
+Finds the Haml file imported as fullname and returns a Loader for it.  Names
+are looked up next to the file relative_to, by default the file being
+rendered, then in the search path.  Names starting with // are looked up in the
+search path, or in the current directory if there is none.
+        """
+        if relative_to is None:
+            relative_to = self.op.filename
+        dirs = [dir for dir in self.op.search_path.split(os.pathsep) if dir]
+        if fullname.startswith("//"):
+            fullname = fullname[2:]
+            dirs = dirs or [os.curdir]
+        elif relative_to is not None:
+            dirs.insert(0, os.path.dirname(relative_to))
+        path = self._index.find(tuple(dirs), fullname, self.op.revalidate)
+        if path is None:
+            raise ImportError, "could not find %s.haml in %s" % (fullname,
+                os.pathsep.join(dirs) or "the search path")
+        return Loader(self, path)
+
+    def load_module(self, fullname, path, loader, code=None):
+        """
+Imports a Haml file as a module.  A module is only run again if its file or
+the options changed since it was last run, or if its top level does more than
+define functions and import modules, such as writing HTML or reading the
+render's arguments, which has to be done again every time it is imported.
+Modules are kept in the engine's registry rather than sys.modules, so the
+import statement asks the engine for them every time.  code is the module's
+code if it is already known.
+        """
         fullname = self._modulename(fullname)
-        mod = imp.new_module(fullname)
-        mod = sys.modules.setdefault(fullname, mod)
+        key = (self.loader.fingerprint(path), self._options())
+        entry = self._modules.get(path)
+        if entry is not None:
+            (k, mod, defined, given) = entry
+            #a module holding on to modules that changed is run again too
+            if k == key and self._cache.fresh(path):
+                #hand the module this render's _haml and arguments, and take
+                #back those of earlier renders that this one does not have
+                for name in given.difference(self.context):
+                    mod.__dict__.pop(name, None)
+                given.clear()
+                for (name, value) in self.context.items():
+                    if not name in defined:
+                        mod.__dict__[name] = value
+                        given.add(name)
+                self._imported[-1].append(mod)
+                return mod
+            self._modules.pop(path)
+        if path in self._loading:
+            return self._loading[path]
+        if code is None:
+            code = loader.get_code(fullname)
+        mod = HamlModule(fullname)
         mod.__file__ = path
         mod.__loader__ = loader
-        mod.__dict__.update(self.globals)
-        ex(code, mod.__dict__)
+        mod.__dict__.update(self.context)
+        self._loading[path] = mod
+        self._imported.append(mod.imported)
+        try:
+            ex(code, mod.__dict__)
+        finally:
+            del self._loading[path]
+            self._imported.pop()
+        self._imported[-1].append(mod)
+        if reusable(code):
+            defined = set(name for (name, value) in self.context.items()
+                if mod.__dict__.get(name) is not value)
+            self._modules.put(path, key, mod, defined,
+                set(self.context).difference(defined))
         return mod
 
+    def invalidate(self, path=None):
+        """
+Forgets the compiled code, blocks and imported module of a Haml file and of
+every file importing it, or of every file if path is None, so they are compiled
+and run again when next used.  Forgetting every file also forgets where
+imported names were found.
+        """
+        for stale in self._cache.invalidate(path):
+            self._blocks.pop(stale, None)
+        if path is None:
+            self._modules.clear()
+            self._index.clear()
+            self._blocks.clear()
+
+    def _forget(self, paths):
+        """
+Drops the imported modules of Haml files whose code was invalidated, so that
+neither _haml.imp nor the import statement hands them out again.
+        """
+        for path in paths:
+            self._modules.pop(path)
+
+    def imports(self, s, filename):
+        """
+Returns the paths of the Haml files that the Haml source s of a file imports
+with _haml.imp or an import statement, as far as they can be found.
+        """
+        names = [m.group(2) for m in imp_call.finditer(s)]
+        for m in import_line.finditer(s):
+            if m.group(2):
+                names.append(m.group(2))
+            else:
+                names.extend(name.split()[0]
+                    for name in m.group(1).split(',') if name.strip())
+        paths = []
+        for name in names:
+            try:
+                paths.append(self.find_module(name, filename).path)
+            except ImportError:
+                pass
+        return paths
+
+    def dependencies(self, path):
+        """Returns the Haml files a compiled Haml file imports."""
+        return set(self._cache.imports.get(path, ()))
+
+    def dependents(self, path):
+        """
+Returns the compiled Haml files that import a Haml file, directly or through
+other files.  These are the files to compile again when it changes.
+        """
+        return self._cache.dependents(path)
+
     def imp(self, fullname):
-        finder = Finder(self)
-        loader = finder.find_module(fullname)
-        if loader:
+        loader = self.find_module(fullname)
+        #hold the import lock like the import statement does
+        imp.acquire_lock()
+        try:
             return loader.load_module(fullname)
-        return None
+        finally:
+            imp.release_lock()
+
+    def linked(self, fullname, path, code):
+        """
+Imports a Haml file linked into the template being rendered, which carries the
+file's code, so the file is neither looked up nor loaded.
+        """
+        imp.acquire_lock()
+        try:
+            return self.load_module(fullname, path, Loader(self, path), code)
+        finally:
+            imp.release_lock()
 
     def entab(self):
         self.depth += 1
@@ -220,14 +604,29 @@ Sets options for the Haml engine.  Options should be given as keyword arguments.
             v = unicode(v).replace(w, {'"':'&quot;', "'":'&#39;'}[w])
             self.write(' %s=%s%s%s' % (k,w,v,w))
 
-    def compile(self, s, filename="<string>"):
+    def _lexer(self):
         """
-Compile a HAML string, returning a Python code object that can be exec'd.
-Optional filename parameter specifies the name of the file containing the HAML
-code, which helps give better error messages.
+Returns the lexer backend chosen by the lexer option.
+        """
+        if self.op.lexer == 'line':
+            return self.line_lexer
+        return self.lexer
+
+    def _parse(self, s, tracking=False, indent=(None, None)):
         """
-        self.parser.__dict__.update({
+Parses a HAML string into a node tree and lowers it.  Returns the parser, whose
+src holds the generated HamlCalls.  PLY only tracks the position of every
+symbol if tracking is true.  indent is the indentation character and width the
+lexer starts with, if they are already known.
+        """
+        if self.op.parser == 'line':
+            parser = self.line_parser
+        else:
+            parser = self.parser
+        parser.__dict__.update({
             'depth': 0,
+            'root': [],
+            'nodes': [],
             'src': [],
             'last_obj': None,
             'debug': self.op.debug,
@@ -235,73 +634,327 @@ code, which helps give better error messages.
             'to_close': [],
             'preserve': 0,
             'lineno': 1,
+            'source': s,
+            'tracking': tracking,
         })
 
-        self.lexer.begin('INITIAL')
-        self.lexer.__dict__.update({
+        backend = self._lexer()
+        backend.begin('INITIAL')
+        backend.__dict__.update({
             'depth': 0,
-            'type': None,
-            'length': None,
+            'type': indent[0],
+            'length': indent[1],
             'block': None,
             'lineno': 1,
+            'op': self.op,
+            'diagnostics': [],
         })
 
+        parser.parse(s, lexer=backend, debug=self.op.debug, tracking=tracking)
+        ir.lower(parser)
+        return parser
+
+    def compile(self, s, filename="<string>"):
+        """
+Compile a HAML string, returning a Python code object that can be exec'd.
+Optional filename parameter specifies the name of the file containing the HAML
+code.  It becomes the code object's file name, and the code object's line
+numbers are those of the HAML source, so tracebacks point at HAML lines.
+Problems that do not stop the compile are left in the diagnostics attribute.
+If filename is a template, the files it imports are recorded in the cache.
+        """
+        self.diagnostics = []
+        if self.loader.fingerprint(filename) is not None:
+            self._cache.depend(filename, self.imports(s, filename))
+        #blocks are reused while their text is unchanged, which says nothing
+        #about the files linked into them
+        if self.op.incremental and not self.op.link:
+            code = self._compile_blocks(s, filename)
+            if code is not None:
+                return code
+            self.diagnostics = []
+        code, linemap, _ = self._compile(s, filename)
+        self._register(code, linemap)
+        return code
+
+    def _compile_blocks(self, s, filename):
+        """
+Compiles a HAML string one top-level block at a time, reusing the code of the
+blocks that have not changed since the file was last compiled.  Returns None
+if the blocks can not be compiled on their own, or if one has illegal lines,
+in which case the whole string is compiled and any errors are reported from
+there.
+        """
+        parts = blocks.split(s)
+        if len(parts) < 2:
+            return None
+        options = repr(sorted(self.op.__dict__.items()))
+        old = self._blocks.get(filename, {})
+        new = {}
+        #every block starts with the indentation found by the blocks before it
+        indent = (None, None)
+        codes = []
+        for lineno, text in parts:
+            key = (text, indent, options)
+            entry = old.get(key) or new.get(key)
+            if entry is None:
+                try:
+                    code, _, lexer = self._compile(text, filename, indent)
+                except HamlException:
+                    return None
+                #the lines after an illegal line may nest under the blocks
+                #before it, which only the whole string can tell
+                if lexer.diagnostics:
+                    return None
+                entry = (code, (lexer.type, lexer.length))
+            new[key] = entry
+            code, indent = entry
+            codes.append((lineno, blocks.relocate(code, filename, lineno - 1)))
+        self._blocks[filename] = new
+        code = blocks.link(codes, filename)
+        #the blocks' line numbers are already Haml line numbers, so the line
+        #map only needs to find the Haml text
+        self._register(code, self._linemap(filename, s))
+        return code
+
+    def _compile(self, s, filename, indent=(None, None)):
+        """
+Compiles a HAML string.  Returns the code object, its LineMap and the lexer
+that read the string.
+        """
+        calls = self._calls(s, filename, indent)
+        code, linemap = self._codegen(calls, filename, s)
+        return code, linemap, self._lexer()
+
+    def _calls(self, s, filename, indent=(None, None)):
+        """
+Parses a HAML string and returns the optimized HamlCalls generated for it.
+        """
         try:
-            self.parser.parse(s, lexer=self.lexer, debug=self.op.debug, tracking=True)
+            try:
+                parser = self._parse(s, indent=indent)
+            except HamlParserException:
+                #positions are only tracked for error messages, so parse again
+                #with tracking on to raise a detailed exception
+                parser = self._parse(s, tracking=True, indent=indent)
         except HamlParserException, ex:
             lineno, haml_line, msg = ex
             if type(haml_line) == int:
                 #interpret haml_line as character position to get the line
-                haml_line = get_lines_in_position_range(self.lexer.lexdata,
-                    haml_line, haml_line)
-            raise HamlException, "Parse error in file %r: %s at line %d:\n%s\n%s" % \
-(filename, msg, lineno, haml_line, traceback.format_exc())
-        #add a line too the beginning of the Python source indicating which
-        #Haml file this is.  This can be accessed later for getting descriptive
-        #error messages.
-        lines = ["HAML_file_name = %r" % filename]
-        #haml_lines maps Python lines to Haml (line number, code) pairs.
-        haml_lines = [(0, "<no line 0>"), (0, "<HAML setup>")]
-        for call in self.parser.src:
-            line = str(call)
-            lines.append(line)
-            haml_line = call.haml.posinfo
-            #append once for every Python line this Haml call turned into
-            for i in range(1 + line.count('\n')):
-                haml_lines.append(haml_line)
-        self.haml_line_cache[filename] = haml_lines
+                haml_line = get_lines_in_position_range(s, haml_line,
+                    haml_line)
+            ex = HamlException("Parse error in file %r: %s at line %d:\n%s\n%s" % \
+(filename, msg, lineno, haml_line, traceback.format_exc()))
+            ex.diagnostics = self.diagnostics + self._lexer().diagnostics
+            raise ex
+        for d in self._lexer().diagnostics:
+            logging.warning('%s file: %s', d, filename)
+            self.diagnostics.append(d)
+        self.timings = {}
+        return ir.optimize(parser.src, self.op.optimize, self.timings)
+
+    def _codegen(self, calls, filename, s=None):
+        """
+Turns HamlCalls into a code object.  Returns the code object and its LineMap.
+s is the HAML source, which is read through the loader if it is needed and
+not given.
+        """
+        #linemap maps Python line numbers to Haml line numbers.  Line tables
+        #can only step forward, so Python lines generated for an earlier Haml
+        #line (such as closing tags) are charged to the latest line seen.
+        linemap = self._linemap(filename, s)
+        lines = []
+        last = 1
+        #a file linking to itself, directly or not, imports itself when run
+        linking = self.op.link and set([filename]) - self._linking or set()
+        self._linking |= linking
+        codes = {}
+        try:
+            for call in calls:
+                line = str(call)
+                if self.op.link and '_haml.imp' in line:
+                    line = self._link(line, filename, codes)
+                lines.append(line)
+                last = max(last, call.haml.posinfo[0])
+                #append once for every Python line this Haml call turned into
+                linemap.append(last, 1 + line.count('\n'))
+        finally:
+            self._linking -= linking
         src = '\n'.join(lines) + '\n'
         try:
-            #important for file to be "<haml>" so execute() can detect Haml
-            #code in tracebacks
-            return code.compile_command(src, "<haml>", "exec")
+            code = compile(src, filename, 'exec')
         except SyntaxError:
             exc_type, exc_value, exc_traceback = sys.exc_info()
-            haml_line_number, haml_line = self.get_haml_line_info(filename,
-exc_value.lineno, exc_value.text)
+            haml_line_number = linemap[exc_value.lineno or 0]
+            haml_line = linemap.text(haml_line_number)
             #change the syntax error message to show the Haml code
             message = traceback.format_exception_only(exc_type, exc_value)
             #message[0] was originally 'File "<pythonfile>", line <pythonline>'
             message[0] = '  File "%s", line %d\n' % (filename, haml_line_number)
             #message[1] was originally the python line with the syntax error
             message[1] = '    %s\n  Python:\n%s' % (haml_line, message[1])
-            raise HamlException, ''.join(message)
+            ex = HamlException(''.join(message))
+            ex.diagnostics = self.diagnostics
+            raise ex
+        #renumber the code so its line table points straight at the Haml source
+        code = blocks.renumber(code, linemap.lines)
+        if codes:
+            code = blocks.embed(code, codes)
+        return code, linemap
+
+    def _link(self, line, filename, codes):
+        """
+Turns the _haml.imp calls in a line of generated Python that import a Haml file
+by a fixed name into _haml.linked calls, which are handed the imported file's
+code, and returns the line.  The code objects are left in the line as string
+placeholders, which are added to the dict codes with the code objects.  Files
+that can not be found or compiled, and files already being linked, are left to
+be imported when the code runs.
+        """
+        try:
+            tokens = list(tokenize.generate_tokens(StringIO(line).readline))
+        except (tokenize.TokenError, IndentationError):
+            return line
+        #calls spelled out inside strings and comments are not calls
+        starts = [0]
+        for text in line.splitlines(True):
+            starts.append(starts[-1] + len(text))
+        quoted = [(starts[srow - 1] + scol, starts[erow - 1] + ecol)
+            for (kind, _, (srow, scol), (erow, ecol), _) in tokens
+            if kind in (tokenize.STRING, tokenize.COMMENT)]
+        for m in reversed(list(imp_call.finditer(line))):
+            if m.start() and (line[m.start() - 1].isalnum() or
+                              line[m.start() - 1] in '_.'):
+                continue
+            if [q for q in quoted if q[0] <= m.start() < q[1]]:
+                continue
+            try:
+                path = self.find_module(m.group(2), filename).path
+            except ImportError:
+                continue
+            if path in self._linking:
+                continue
+            #compiling the file links the files it imports in turn
+            diagnostics = self.diagnostics
+            try:
+                code = self.cache(path)
+            except (HamlException, IOError):
+                continue
+            finally:
+                self.diagnostics = diagnostics
+            placeholder = '\0haml-link:%s' % path
+            codes[placeholder] = code
+            line = '%s_haml.linked(%r, %r, %r)%s' % (line[:m.start()],
+                m.group(2), path, placeholder, line[m.end():])
+        return line
+
+    def _linemap(self, filename, s=None):
+        """
+Returns an empty LineMap for a Haml file.  Files on disk are read through
+linecache, other templates through the loader, unless their source s is given.
+        """
+        if isinstance(self.loader, FileSystemLoader) and \
+           self.loader.root is None and os.path.isfile(filename):
+            return LineMap(filename)
+        if s is None:
+            s = lambda: self.loader.get_source(filename)
+        return LineMap(filename, s)
+
+    def _compile_ir(self, filename):
+        """
+Compiles a Haml file through the intermediate code kept for it in the ir_cache
+directory.  The file is only parsed when there is no intermediate code for its
+source and the current options; that code is then written out for the next
+time.
+        """
+        if json is None:
+            raise HamlException('the ir_cache option needs the json module, '
+                'or simplejson on Python 2.5')
+        self.diagnostics = []
+        path = self.ir_path(filename)
+        s = self.loader.get_source(filename)
+        #the source rather than its fingerprint, which changes with every
+        #checkout of the file
+        key = hashlib.md5(repr((self._options(),
+            hashlib.md5(s).hexdigest()))).hexdigest()
+        self._cache.depend(filename, self.imports(s, filename))
+        calls = None
+        if os.path.isfile(path):
+            with open(path) as f:
+                calls = ir.load(f, key)
+        if calls is None:
+            calls = self._calls(s, filename)
+            try:
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with atomic_write(path, 'w') as f:
+                    ir.dump(calls, f, key)
+            except (IOError, OSError, UnicodeError):
+                logging.exception("could not write %s:", path)
+        code, linemap = self._codegen(calls, filename)
+        self._register(code, linemap)
+        return code
+
+    def ir_path(self, filename):
+        """
+Returns the path of the file the intermediate code of a Haml file is kept in.
+The file is named by the Haml file's path relative to the loader's root, or to
+the directory of the search path or the current directory holding it, so that
+every checkout of the templates shares it.  Files outside of all of them are
+named by their absolute path.
+        """
+        name = filename
+        if isinstance(self.loader, FileSystemLoader):
+            path = os.path.abspath(self.loader.path(filename))
+            dirs = [self.loader.root]
+            if self.loader.root is None:
+                dirs = [dir for dir in self.op.search_path.split(os.pathsep)
+                    if dir] + [os.curdir]
+            name = path
+            for dir in dirs:
+                dir = os.path.join(os.path.abspath(dir), '')
+                if path.startswith(dir):
+                    name = path[len(dir):]
+                    break
+        return os.path.join(self.op.ir_cache,
+            *(normalize(name) + '.hamlir').split('/'))
+
+    def _register(self, code, linemap):
+        """
+Records the LineMap of a compiled code object, which also serves the code
+objects it contains that were compiled from the same file.
+        """
+        self._named_linemaps[code.co_filename] = linemap
+        codes = [code]
+        while codes:
+            code = codes.pop()
+            self._linemaps[code] = linemap
+            codes.extend(c for c in code.co_consts
+                if isinstance(c, types.CodeType) and
+                   c.co_filename == code.co_filename)
+
+    def get_linemap(self, code):
+        """
+Returns the LineMap of a compiled, still cached code object, or of one of the
+code objects it contains, or None.
+        """
+        return self._linemaps.get(code)
 
     def get_haml_line_info(self, haml_file_name, python_line_number,
                            python_text="<unknown Python>"):
         """
-Given a Haml file name and Python line number, figure out what Haml code in the
-file produced the Python line.  Returns pair (Haml line number, Haml code).
-Optional python_text argument specifies the Python code that caused the error,
-which is used in case the Haml line can't be found.
+Given a Haml file name and the line number of the Python generated for it by
+the file's latest, still cached compile, figure out what Haml code in the file
+produced the Python line.  Returns pair
+(Haml line number, Haml code).  Optional python_text argument specifies the
+Python code, which is used in case the Haml line can't be found.
         """
-        haml_lines = self.haml_line_cache.get(haml_file_name, [])
-        if python_line_number < len(haml_lines):
-            return haml_lines[python_line_number]
-        else:
-            return (-1, "-# Python at line %d with unknown HAML: %s" %
-                    (python_line_number, python_text))
-
+        linemap = self._named_linemaps.get(haml_file_name)
+        if linemap is not None and linemap[python_line_number] != -1:
+            haml_line_number = linemap[python_line_number]
+            return (haml_line_number, linemap.text(haml_line_number))
+        return (-1, "-# Python at line %d with unknown HAML: %s" %
+                (python_line_number, python_text))
 
     def execute(self, src, *args, **kwargs):
         """
@@ -311,48 +964,85 @@ traceback.
         self.reset()
         if len(args) > 0:
             self.globals.update(args[0])
+            self.context.update(args[0])
         if hasattr(self.op, "debug") and self.op.debug:
             sys.stdout.write(src)
-        finder = Finder(self)
-#        sys.meta_path.append(finder)
+        finder.install()
+        finder.engines().append(self)
         try:
             ex(src, self.globals)
             return self.html.getvalue().strip() + '\n'
         except:
             logging.exception("error rendering haml:")
             exc_type, exc_value, exc_traceback = sys.exc_info()
+            #compiled templates carry their Haml file name and line numbers,
+            #so only the text of templates that are not files is missing.
+            #Every template compiled from a string has the same file name, so
+            #the line map is found from the code being run.
             tb = traceback.extract_tb(exc_traceback)
-            for i, trace in enumerate(tb):
-                logging.info("trace: %r", trace)
-                python_file_name = trace[0]
-                python_line_number = trace[1] if len(trace) > 1 else None
-                function_name = trace[2] if len(trace) > 2 else None
-                python_text = trace[3] if len(trace) > 3 else None
-                local = trace[4] if len(trace) > 4 else None
-
-                if python_file_name == "<haml>":
-                    haml_file_name = exc_traceback.tb_frame.f_globals.get(
-                        "HAML_file_name", "<string>")
-                    haml_line_number, haml_line = self.get_haml_line_info(
-                        haml_file_name, python_line_number, python_text)
-                    tb[i] = (haml_file_name, haml_line_number, function_name,
-                             haml_line)
+            codes = []
+            while exc_traceback is not None:
+                codes.append(exc_traceback.tb_frame.f_code)
                 exc_traceback = exc_traceback.tb_next
+            for i, (filename, lineno, function_name, text) in enumerate(tb):
+                linemap = self.get_linemap(codes[i])
+                if text is None and linemap is not None:
+                    text = linemap.text(lineno).strip()
+                    tb[i] = (filename, lineno, function_name, text)
             formatted = ["Traceback (most recent call last):\n"]
             formatted += traceback.format_list(tb)
             formatted += traceback.format_exception_only(exc_type, exc_value)
             raise HamlException, "".join(formatted)
-        # finally:
-        #     sys.meta_path.remove(finder)
+        finally:
+            finder.engines().pop()
+            #let go of the modules the template imported
+            self._imported = [[]]
 
     def cache(self, filename):
         """
 Given a Haml filename, returns a Python code object that generates the HTML for
-that Haml file.  This uses a cache so the same file isn't compiled twice.
+that Haml file.  This uses a cache so the same file isn't compiled twice, unless
+a file it imports changed.  Templates of a Bundle are never compiled.  The code
+of other files comes from the first of these that has it for the current
+versions of the file and the options:
+
+    the .pyc file, finished code for this interpreter
+    the ir_cache directory, which any interpreter can read
+    compiling the source, which writes the intermediate code to ir_cache
+
+and is written to the .pyc file unless it was read from there.
         """
-        if not filename in self._cache:
-            with open(filename) as haml:
-                self._cache[filename] = self.compile(haml.read(), filename)
+        if not self._cache.fresh(filename):
+            if isinstance(self.loader, Bundle):
+                code, linemap, deps = self.loader.load(filename,
+                    self._options())
+                self._cache.depend(filename, deps)
+                self._register(code, linemap)
+                self._cache[filename] = code
+                return code
+            loader = Loader(self, filename)
+            code = loader.read_code()
+            if code is not None:
+                linked = blocks.linked(code)
+                self._cache.depend(filename, linked.union(
+                    self.imports(self.loader.get_source(filename), filename)))
+                self._register(code, self._linemap(filename))
+                #cache the linked files, so that changes to them are noticed
+                for path in linked:
+                    self.cache(path)
+            else:
+                if self.op.ir_cache:
+                    code = self._compile_ir(filename)
+                else:
+                    code = self.compile(self.loader.get_source(filename),
+                        filename)
+                if loader.cache_path() is not None and \
+                   not dont_write_bytecode():
+                    try:
+                        loader.write_code(code)
+                    except (IOError, OSError):
+                        pass
+            self._cache[filename] = code
         return self._cache[filename]
 
     def to_html(self, s, *args, **kwargs):
@@ -382,14 +1072,27 @@ render = eng.render
 if __name__ == '__main__':
     (op, args) = Engine.optparser.parse_args(sys.argv[1:])
 
-    if op.batch:
+    if op.batch and op.bundle:
+        #names in the bundle are relative to the directory compiled
+        root = args and args[0] or os.curdir
+        eng.loader = FileSystemLoader(root)
         eng.setops(**op.__dict__)
-        for p in (s for s in args if s.endswith('.haml')):
-            eng.cache(p)
+        bundle.build(eng, bundle.templates(root), op.bundle)
+    elif op.batch:
+        import batch
+        errors = batch.run(batch.templates(args), op.__dict__, op.manifest,
+            op.jobs)
+        if errors:
+            sys.stderr.write(batch.report(errors))
+            sys.exit(1)
     else:
+        if op.bundle:
+            eng.loader = Bundle(op.bundle)
         if not len(args):
             s = to_html(sys.stdin.read(), **op.__dict__)
         else:
+            #render takes the file name as its first argument
+            del op.__dict__['filename']
             s = render(args[0], **op.__dict__)
 
         sys.stdout.write(s)
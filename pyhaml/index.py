@@ -0,0 +1,60 @@
+import os
+import time
+
+def listfiles(dir):
+    """Returns the files in a directory, or none if it can not be listed."""
+    try:
+        return os.listdir(dir or os.curdir)
+    except OSError:
+        return []
+
+class TemplateIndex(object):
+    """
+Finds Haml files by name in a list of directories.  Each directory is listed
+once into a set of the template names in it, and every lookup is remembered,
+including those that find nothing.  Everything is forgotten once the index is
+older than the max_age given to find, so new and removed files are noticed
+after at most that many seconds.
+    """
+
+    def __init__(self, clock=time.time, listdir=None):
+        self.clock = clock
+        #lists the files in a directory, such as a template loader's listdir
+        self.listdir = listdir or listfiles
+        self.clear()
+
+    def clear(self):
+        #template names in each directory, without the .haml extension
+        self.dirs = {}
+        #path found for each (directories, name), or None
+        self.lookups = {}
+        self.scanned = None
+
+    def find(self, dirs, name, max_age=0):
+        """
+Returns the path of the first file name + '.haml' in a tuple of directories,
+or None.  name may contain slashes to look in subdirectories.
+        """
+        now = self.clock()
+        if self.scanned is None or now - self.scanned > max_age:
+            self.clear()
+            self.scanned = now
+        key = (dirs, name)
+        if key in self.lookups:
+            return self.lookups[key]
+        path = None
+        for dir in dirs:
+            (sub, base) = os.path.split(name)
+            if base in self.names(os.path.join(dir, sub)):
+                path = os.path.join(dir, '%s.haml' % name)
+                break
+        self.lookups[key] = path
+        return path
+
+    def names(self, dir):
+        """Returns the set of template names in a directory."""
+        if not dir in self.dirs:
+            files = self.listdir(dir)
+            self.dirs[dir] = set(f[:-len('.haml')] for f in files
+                if f.endswith('.haml'))
+        return self.dirs[dir]
@@ -0,0 +1,310 @@
+"""
+The intermediate representation of a compiled template.  The parser builds a
+tree of HamlObjs, which lower turns into a flat list of HamlCalls.  Optimization
+passes then rewrite that list before it is turned into Python code.
+
+A pass is a function taking a list of HamlCalls and returning a new one.  It
+must not modify the calls it is given; they may be shared with other lists.
+Passes are registered with the optimization decorator and switched on by name
+in profiles, which the optimize option selects.  The required passes run
+before those of every profile, since the code is not valid without them.
+
+A list of calls can be written out with dump and read back with load.  The
+format is JSON lines, so it does not depend on the Python version the way
+marshalled code does: loading it only leaves the generation of Python code
+and its compilation to do.
+"""
+import re
+import time
+import tokenize
+
+from parser import HamlCall
+from patch import StringIO, json
+
+passes = {}
+
+def optimization(f):
+    """Registers f as an optimization pass under its name."""
+    passes[f.__name__] = f
+    return f
+
+#version of the format written by dump; load ignores files of other versions
+version = 1
+
+#the passes run whatever the profile: a script line with indented children
+#that do not make a block is only valid Python once its entab and detab are gone
+required = ['cancel_tabs']
+
+#the passes each profile runs after the required ones, in order
+profiles = {
+    'none': [],
+    'default': ['merge_writes'],
+    'inline': ['inline_defs', 'merge_writes'],
+}
+
+#the most calls a helper inlined by inline_defs may have
+inline_size = 16
+
+helper_def = re.compile(r'\s*def\s+(\w+)\s*\(([\w\s,]*)\)\s*:\s*$')
+any_def = re.compile(r'\s*def\s+(\w+)')
+helper_call = re.compile(r'\s*(\w+)\s*\((.*)\)\s*$')
+#arguments that are the same value wherever they are used: names, numbers and
+#simple strings
+plain_arg = re.compile(r'''\s*(\w+|'[^'\\]*'|"[^"\\]*")\s*$''')
+
+def lower(parser):
+    """
+Generates the calls of the node tree in parser.root by opening and closing
+every object depth first, and returns them.
+    """
+    def visit(nodes, depth):
+        for node in nodes:
+            node.begin(depth)
+            if node.children:
+                visit(node.children, depth + 1)
+    visit(parser.root, 0)
+    while len(parser.to_close):
+        parser.to_close.pop().end()
+    return parser.src
+
+def optimize(calls, profile='default', timings=None):
+    """
+Runs the required passes and those of a profile over a list of calls and
+returns the result.  If timings is a dictionary, the seconds taken by each pass
+are stored in it.
+    """
+    for name in required + profiles[profile]:
+        start = time.time()
+        calls = passes[name](calls)
+        if timings is not None:
+            timings[name] = time.time() - start
+    return calls
+
+@optimization
+def cancel_tabs(calls):
+    """Removes entab calls directly followed by a detab at the same depth."""
+    result = []
+    for call in calls:
+        if call.func == 'detab' and result:
+            last = result[-1]
+            if last.func == 'entab' and last.depth == call.depth:
+                result.pop()
+                continue
+        result.append(call)
+    return result
+
+@optimization
+def merge_writes(calls):
+    """Merges consecutive write calls at the same depth into one."""
+    result = []
+    #the merged call at the end of result, which this pass owns
+    merged = None
+    for call in calls:
+        if call.func == 'write' and result:
+            last = result[-1]
+            if last.func == 'write' and last.depth == call.depth:
+                if last is not merged:
+                    merged = HamlCall(haml=last.haml, func='write',
+                        args=list(last.args), depth=last.depth)
+                    result[-1] = merged
+                merged.args.extend(call.args)
+                continue
+        result.append(call)
+    return result
+
+def names(expr):
+    """
+Returns the tokens of a line of Python, and the indexes of the tokens that are
+names of variables rather than of attributes or keyword arguments.
+    """
+    tokens = list(tokenize.generate_tokens(StringIO(expr).readline))
+    code = [i for (i, t) in enumerate(tokens) if t[0] not in (tokenize.NL,
+        tokenize.NEWLINE, tokenize.COMMENT, tokenize.ENDMARKER)]
+    result = []
+    #how many brackets the token is in
+    depth = 0
+    for (j, i) in enumerate(code):
+        text = tokens[i][1]
+        if text in ('(', '[', '{'):
+            depth += 1
+        elif text in (')', ']', '}'):
+            depth -= 1
+        if tokens[i][0] != tokenize.NAME:
+            continue
+        if j > 0 and tokens[code[j - 1]][1] == '.':
+            continue
+        #a keyword argument, not an assignment
+        if depth > 0 and tokens[code[j - 1]][1] in ('(', ',') and \
+           j + 1 < len(code) and tokens[code[j + 1]][1] == '=':
+            continue
+        result.append(i)
+    return tokens, result
+
+def substitute(expr, values):
+    """
+Returns a Python expression with the variables that are keys of values replaced
+by their values.
+    """
+    (tokens, variables) = names(expr)
+    lines = expr.splitlines(True)
+    #replace from the end, so the positions of earlier tokens stay right
+    for i in reversed(variables):
+        (_, name, (row, start), (_, end), _) = tokens[i]
+        if name in values:
+            line = lines[row - 1]
+            lines[row - 1] = '%s(%s)%s' % (line[:start], values[name],
+                line[end:])
+    return ''.join(lines)
+
+def helpers(calls):
+    """
+Finds the helpers in a list of calls that inline_defs can inline: functions
+defined at the top level whose bodies are at most inline_size _haml calls that
+neither refer to the function nor bind names, that are defined only once and
+that no other line of Python mentions.  Returns a dict of their names to (index
+of the def, parameters, calls of the body).
+    """
+    found = {}
+    #how many times each name is defined, at any depth
+    defs = {}
+    for (i, call) in enumerate(calls):
+        d = call.func is None and any_def.match(call.script)
+        if d:
+            defs[d.group(1)] = defs.get(d.group(1), 0) + 1
+        m = d and call.depth == 0 and helper_def.match(call.script)
+        if not m:
+            continue
+        params = [p.strip() for p in m.group(2).split(',') if p.strip()]
+        body = []
+        for c in calls[i + 1:]:
+            if c.depth == 0:
+                break
+            body.append(c)
+        if not body or len(body) > inline_size or \
+           [c for c in body if c.func is None or c.depth != 1]:
+            continue
+        used = set()
+        try:
+            for c in body:
+                for arg in c.args:
+                    if isinstance(arg, basestring):
+                        (tokens, variables) = names(arg)
+                        used.update(tokens[j][1] for j in variables)
+        except (tokenize.TokenError, IndentationError):
+            continue
+        if not used & set([m.group(1), 'lambda', 'for']):
+            found[m.group(1)] = (i, params, body)
+    #calls after a name is defined again run the other function
+    for name in list(found):
+        if defs[name] > 1:
+            del found[name]
+    #a helper mentioned by any other line of Python may be rebound or handed
+    #around, so calls to it are left alone
+    for call in calls:
+        if not found:
+            break
+        if call.func is not None or helper_def.match(call.script):
+            continue
+        try:
+            (tokens, variables) = names(call.script.strip())
+        except (tokenize.TokenError, IndentationError):
+            return {}
+        mentioned = set(tokens[j][1] for j in variables)
+        m = helper_call.match(call.script)
+        if m:
+            mentioned.discard(m.group(1))
+        for name in mentioned & set(found):
+            del found[name]
+    return found
+
+@optimization
+def inline_defs(calls):
+    """
+Replaces statements calling small helper functions defined in the same
+template by the calls of the helpers' bodies, with the arguments substituted
+for the parameters.  Only calls outside of functions and classes, after the
+helper is defined, whose arguments are names, numbers or simple strings are
+inlined, so that they behave exactly like calling the helper.  The helpers'
+definitions are kept, for other templates importing them.
+    """
+    found = helpers(calls)
+    if not found:
+        return calls
+    result = []
+    #the depth of the function or class the calls are in, if any
+    scope = None
+    for (i, call) in enumerate(calls):
+        if scope is not None and call.depth <= scope:
+            scope = None
+        m = call.func is None and helper_call.match(call.script)
+        helper = m and found.get(m.group(1))
+        if scope is None and helper and helper[0] < i:
+            (_, params, body) = helper
+            args = [a for a in m.group(2).split(',') if a.strip()]
+            if len(args) == len(params) and \
+               not [a for a in args if not plain_arg.match(a)]:
+                values = dict(zip(params, [a.strip() for a in args]))
+                for c in body:
+                    result.append(HamlCall(haml=call.haml, func=c.func,
+                        args=[isinstance(a, basestring) and substitute(a, values) or a
+                            for a in c.args],
+                        depth=call.depth + c.depth - 1))
+                continue
+        if scope is None and call.func is None and \
+           re.match(r'\s*(def|class)\b', call.script):
+            scope = call.depth
+        result.append(call)
+    return result
+
+class Position(object):
+    """
+Stands in for the HamlObj of a loaded call.  Only the Haml line of a call is
+kept, for line numbers and error messages.
+    """
+
+    __slots__ = ('posinfo',)
+
+    def __init__(self, lineno):
+        self.posinfo = (lineno, -1, -1)
+
+def native(s):
+    """Returns a string read from JSON as a native str."""
+    if s is None or isinstance(s, str):
+        return s
+    return s.encode('utf-8')
+
+def dump(calls, f, key):
+    """
+Writes a list of calls to the file f.  The first line is a header holding the
+format version and key, a string describing everything the calls were
+generated from.  Every other line is a JSON array [Haml line, depth, func,
+args, script] for one call.  Arguments that are not strings are written as the
+Python code they turn into.
+    """
+    header = {'format': 'pyhaml-ir', 'version': version, 'key': key}
+    f.write(json.dumps(header) + '\n')
+    for call in calls:
+        args = [isinstance(arg, basestring) and arg or str(arg)
+            for arg in call.args]
+        f.write(json.dumps([call.haml.posinfo[0], getattr(call, 'depth', 0),
+            call.func, args, call.script]) + '\n')
+
+def load(f, key):
+    """
+Reads a list of calls written by dump from the file f.  Returns None if the
+file is damaged, has another format version or was written with another key.
+    """
+    try:
+        header = json.loads(f.readline())
+        if header != {'format': 'pyhaml-ir', 'version': version, 'key': key}:
+            return None
+        #one array of every line is decoded much faster than line by line
+        rows = json.loads('[%s]' % ','.join(f.readlines()))
+        calls = []
+        for lineno, depth, func, args, script in rows:
+            calls.append(HamlCall(haml=Position(lineno), depth=depth,
+                func=native(func), args=[native(arg) for arg in args],
+                script=native(script)))
+        return calls
+    except (ValueError, TypeError):
+        return None
@@ -1,11 +1,7 @@
-import haml
 import os
-import sys
-import token
+import re
 from tokenize import TokenError
 
-from patch import toks, untokenize
-
 class HamlParserException(Exception):
     """
 An error thrown by the Haml lexer or parser (not the generated Python code).
@@ -16,6 +12,28 @@ line, which can be used to actually retreive the Haml line.
     """
     pass
 
+class Diagnostic(object):
+    """
+A problem found while lexing that does not stop a template from compiling,
+such as a run of illegal characters.  lineno and lexpos tell where it starts
+and text is the Haml text it is about.
+    """
+
+    __slots__ = ('lineno', 'lexpos', 'text', 'message')
+
+    def __init__(self, lineno, lexpos, text, message):
+        self.lineno = lineno
+        self.lexpos = lexpos
+        self.text = text
+        self.message = message
+
+    def __str__(self):
+        return '%s [%s] lineno: %s' % (self.message, self.text[:80], self.lineno)
+
+    def __repr__(self):
+        return 'Diagnostic(%r, %r, %r, %r)' % (
+            self.lineno, self.lexpos, self.text, self.message)
+
 tokens = (
     'LF',
     'DOCTYPE',
@@ -56,50 +74,91 @@ def build(self, **kwargs):
     self.lexer.block = None
     return self
 
-def pytokens(t):
-    """Splits the string starting at t's position into Python tokens, yielding them."""
+python_special = re.compile(r'[\'"#\\()\[\]{}\n]')
+
+string_ends = {
+    "'": re.compile(r"\\.|'|\n", re.S),
+    '"': re.compile(r'\\.|"|\n', re.S),
+    "'''": re.compile(r"\\.|'''", re.S),
+    '"""': re.compile(r'\\.|"""', re.S),
+}
+
+def scan_python(lexdata, pos, close=None):
+    """Finds where the Python source starting at pos ends, without tokenizing
+it.  Brackets, strings, comments and backslash continuations are skipped.  If
+close is None the source ends at the first newline outside of them, otherwise
+at the first unbalanced close character.  Returns the position of that newline
+or character (or the length of lexdata), and raises TokenError if lexdata ends
+in the middle of a bracket or string."""
+    depth = 0
+    while True:
+        m = python_special.search(lexdata, pos)
+        if not m:
+            if depth or close:
+                raise TokenError('EOF in multi-line statement')
+            return len(lexdata)
+        c = m.group()
+        pos = m.end()
+        if c in '([{':
+            depth += 1
+        elif c in ')]}':
+            if depth == 0 and c == close:
+                return m.start()
+            depth = max(depth - 1, 0)
+        elif c == '\n':
+            if depth == 0 and close is None:
+                return m.start()
+        elif c == '\\':
+            pos += 1
+        elif c == '#':
+            pos = lexdata.find('\n', pos)
+            if pos == -1:
+                pos = len(lexdata)
+        else:
+            if lexdata[m.start():m.start() + 3] == c * 3:
+                c *= 3
+            end = string_ends[c]
+            m = end.search(lexdata, m.start() + len(c))
+            while m and m.group()[0] == '\\':
+                m = end.search(lexdata, m.end())
+            if not m:
+                if len(c) == 3:
+                    raise TokenError('EOF in multi-line string')
+                pos = len(lexdata)
+            elif m.group() == '\n':
+                #an unterminated string ends with its line, and is left for
+                #the Python compiler to report
+                pos = m.start()
+            else:
+                pos = m.end()
+
+def scan(t, pos, close=None):
+    """Calls scan_python on t's lexer, turning errors into
+HamlParserExceptions."""
     try:
-        for tok in toks(t.lexer.lexdata[t.lexer.lexpos:]):
-            _, s, _, (_, ecol), _ = tok
-            yield tok
-            for _ in range(s.count('\n')):
-                t.lexer.lineno += 1
-                t.lexer.lexpos = t.lexer.lexdata.find('\n', t.lexer.lexpos) + 1
+        return scan_python(t.lexer.lexdata, pos, close)
     except TokenError, ex:
         raise HamlParserException, (t.lineno, t.lexpos, ex[0])
 
 def read_dict(t):
     """Starting from a { token, reads a Python dictionary expression and sets 
-t.value to a string representation of it."""
-    t.value = []
-    lvl = 0
-    for tok in pytokens(t):
-        _, s, _, (_, ecol), _ = tok
-        t.value.append(tok)
-        if s == '{':
-            lvl += 1
-        elif s == '}':
-            lvl -= 1
-            if lvl == 0:
-                t.lexer.lexpos += ecol
-                t.value = untokenize(t.value)
-                return t
+t.value to its source."""
+    start = t.lexer.lexpos
+    end = scan(t, start + 1, '}') + 1
+    t.value = t.lexer.lexdata[start:end]
+    t.lexer.lineno += t.value.count('\n')
+    t.lexer.lexpos = end
+    return t
 
 def read_script(t):
-    """Starting at a script token (- or =), reads a Python script and sets
-t.value to a string representation of it."""
-    src = []
-    for tok in pytokens(t):
-        type, s, _, (_, ecol), _ = tok
-        if s == '':
-            t.lexer.lexpos = len(t.lexer.lexdata)
-            src = untokenize(src).strip()
-            return src
-        src.append(tok)
-        if type == token.NEWLINE:
-            t.lexer.lexpos += ecol - 1
-            src = untokenize(src).strip()
-            return src
+    """Starting at a script token (- or =), reads a Python script and returns
+its source."""
+    start = t.lexer.lexpos
+    end = scan(t, start)
+    src = t.lexer.lexdata[start:end]
+    t.lexer.lineno += src.count('\n')
+    t.lexer.lexpos = end
+    return src.strip()
 
 def t_tag_doctype_comment_INITIAL_LF(t):
     r'\s*\n([\s]*\n)?'
@@ -289,14 +348,33 @@ def t_filter_FILTERCONTENT(t):
     r'[^\n]+'
     return t
 
+def illegal_end(lexer, pos):
+    """
+Returns the end of the run of illegal characters starting at pos in the PLY
+lexer: the first character after it that the lexer ignores or can read a token
+from in its current state.
+    """
+    data = lexer.lexdata
+    end = pos + 1
+    while end < len(data):
+        if data[end] in lexer.lexignore or data[end] in lexer.lexliterals:
+            break
+        if any(r.match(data, end) for (r, _) in lexer.lexre):
+            break
+        end += 1
+    return end
+
+def report(lexer, lineno, pos, end):
+    """
+Records the illegal characters from pos to end as one Diagnostic on the
+lexer, or raises it if the fail_fast option is set.  The lexer carries on
+after them.
+    """
+    d = Diagnostic(lineno, pos, lexer.lexdata[pos:end], 'Illegal character(s)')
+    if lexer.op is not None and lexer.op.fail_fast:
+        raise HamlParserException, (lineno, pos, str(d))
+    lexer.diagnostics.append(d)
+    lexer.lexpos = end
+
 def t_ANY_error(t):
-    msg = 'Illegal character(s) [%s] file: %s lineno: %s\n' % (
-      str(t.value)[:80],
-      haml.eng.op.filename,
-      t.lineno
-    )
-    if haml.eng.op.fail_fast:
-        raise Exception(msg)
-    else:
-        sys.stderr.write(msg)
-        t.lexer.skip(1)
+    report(t.lexer, t.lineno, t.lexpos, illegal_end(t.lexer, t.lexpos))
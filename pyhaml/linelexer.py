@@ -0,0 +1,379 @@
+import re
+
+import lexer
+from lexer import read_dict, read_script
+from ply.lex import LexToken
+
+def rule(f):
+    """Compiles the regular expression of one of the PLY lexer's rules, so
+both lexers agree on what a name or a type looks like."""
+    return re.compile(f.__doc__)
+
+lf_re = rule(lexer.t_tag_doctype_comment_INITIAL_LF)
+blanklines_re = rule(lexer.t_filter_FILTERBLANKLINES)
+tagname_re = rule(lexer.t_TAGNAME)
+id_re = rule(lexer.t_tag_INITIAL_ID)
+classname_re = rule(lexer.t_tag_INITIAL_CLASSNAME)
+condcomment_re = rule(lexer.t_CONDCOMMENT)
+script_re = rule(lexer.t_tag_INITIAL_SCRIPT)
+dict_re = rule(lexer.t_tag_DICT)
+tag_value_re = rule(lexer.t_tag_VALUE)
+xmltype_re = rule(lexer.t_doctype_XMLTYPE)
+htmltype_re = rule(lexer.t_doctype_HTMLTYPE)
+
+#first characters that can not start a VALUE, on its own line or after a tag
+not_value = set(':=&/#!.%~\n\t -')
+not_tag_value = set('{}<>=&/#!.%~\n\t -')
+whitespace = set(' \t\n\r\f\v')
+
+class Illegal(Exception):
+    """Raised by LineLexer.error while probing for the end of illegal input."""
+    pass
+
+class LineLexer(object):
+    """
+A lexer producing the same tokens as the PLY lexer in lexer.py, written by hand
+for speed.  It walks the source once, a line at a time: indentation is read at
+the start of every line, and silent comments, filters and multiline values are
+handled as blocks of lines instead of through stacked lexer states.  Like the
+PLY lexer it keeps depth, type, length and block attributes for the parser.
+    """
+
+    #true while illegal lexes ahead
+    probing = False
+
+    def __init__(self):
+        self.lexdata = ''
+        self.lexlen = 0
+        self.lexpos = 0
+        self.lineno = 1
+        self.depth = 0
+        self.type = None
+        self.length = None
+        self.block = None
+        #options of the compile, and Diagnostics found so far
+        self.op = None
+        self.diagnostics = []
+        self.begin('INITIAL')
+
+    def begin(self, state):
+        """
+Starts lexing in one of the line modes: 'INITIAL', 'tag', 'doctype',
+'comment', 'silent', 'multi' or 'filter'.
+        """
+        self.state = state
+        #true at the start of every line but the first
+        self.newline = False
+
+    def input(self, s):
+        self.lexdata = s
+        self.lexlen = len(s)
+        self.lexpos = 0
+
+    def skip(self, n):
+        self.lexpos += n
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        t = self.token()
+        if t is None:
+            raise StopIteration
+        return t
+
+    __next__ = next
+
+    def token(self):
+        data = self.lexdata
+        n = self.lexlen
+        while True:
+            pos = self.lexpos
+            while pos < n and data[pos] == '\r':
+                pos += 1
+            if pos >= n:
+                self.lexpos = pos + 1
+                return None
+            self.lexpos = pos
+            if self.newline:
+                self.newline = False
+                self.indent(data, pos)
+                continue
+            t = getattr(self, 'lex_' + self.state)(data, pos)
+            if t is not None:
+                return t
+
+    def make(self, type, value, pos, end=None):
+        t = LexToken()
+        t.type = type
+        t.value = value
+        t.lineno = self.lineno
+        t.lexpos = pos
+        t.lexer = self
+        if end is not None:
+            self.lexpos = end
+        return t
+
+    def error(self, data, pos):
+        if self.probing:
+            raise Illegal
+        end = pos + 1
+        while end < self.lexlen and data[end] != '\r' and \
+              self.illegal(data, end):
+            end += 1
+        lexer.report(self, self.lineno, pos, end)
+
+    def illegal(self, data, pos):
+        """
+Returns whether the character at pos can not start a token in the current
+mode, by lexing from it and undoing whatever that changed.
+        """
+        saved = dict(self.__dict__)
+        self.probing = True
+        try:
+            getattr(self, 'lex_' + self.state)(data, pos)
+            return False
+        except Illegal:
+            return True
+        except Exception:
+            #the input after the run is bad in another way, which is reported
+            #when it is read
+            return False
+        finally:
+            self.__dict__ = saved
+
+    def other(self, data, pos):
+        """Returns a literal token for the character at pos, or reports it."""
+        c = data[pos]
+        if c in lexer.literals:
+            return self.make(c, c, pos, pos + 1)
+        self.error(data, pos)
+
+    def line_end(self, data, pos):
+        """Returns the end of the current line."""
+        end = data.find('\n', pos)
+        if end == -1:
+            return self.lexlen
+        return end
+
+    def lf(self, data, pos):
+        """Returns an LF token if only whitespace is left on this line."""
+        m = lf_re.match(data, pos)
+        if not m:
+            return None
+        t = self.make('LF', m.group(), pos, m.end())
+        self.lineno += t.value.count('\n')
+        self.begin('INITIAL')
+        self.newline = True
+        return t
+
+    def indent(self, data, pos):
+        """
+Reads the indentation at the start of a line and sets depth, ending silent
+comment and filter blocks that the line is not part of.
+        """
+        end = pos
+        while end < self.lexlen and data[end] in ' \t':
+            end += 1
+        if end == pos:
+            if self.block is not None:
+                self.block = None
+                self.begin('INITIAL')
+            self.depth = 0
+            return
+        value = data[pos:end]
+        self.lexpos = end
+        if self.type is None:
+            self.type = value[0]
+            self.length = len(value)
+
+        if self.block is not None:
+            if len(value) // self.length < self.block:
+                self.block = None
+                self.begin('INITIAL')
+            else:
+                tablen = self.length * self.block
+                if tablen < len(value):
+                    self.lexpos -= len(value) - tablen
+                    value = value[:tablen]
+
+        if value.strip(self.type):
+            raise lexer.HamlParserException, (self.lineno, self.lexpos,
+                "mixed indentation")
+
+        (d,r) = divmod(len(value), self.length)
+        if r > 0 or d - self.depth > 1:
+            raise lexer.HamlParserException, (self.lineno, self.lexpos,
+                "invalid indentation")
+
+        self.depth = d
+
+    def value(self, t):
+        """Strips a VALUE token, and starts a multiline value if it ends
+with |."""
+        t.value = t.value.strip()
+        if t.value[0] == '\\':
+            t.value = t.value[1:]
+        if t.value[-2:] in ('\t|',' |'):
+            t.value = t.value[:-1].strip()
+            self.begin('multi')
+        return t
+
+    def script(self, data, pos):
+        m = script_re.match(data, pos)
+        if not m:
+            return None
+        t = self.make('SCRIPT', None, pos, m.end())
+        script_type = m.group().strip()
+        t.value = (script_type, read_script(t))
+        return t
+
+    def lex_INITIAL(self, data, pos):
+        c = data[pos]
+        if c in whitespace:
+            t = self.lf(data, pos)
+            if t is not None:
+                return t
+        if c not in not_value:
+            end = self.line_end(data, pos)
+            return self.value(self.make('VALUE', data[pos:end], pos, end))
+        elif c == '-':
+            if data[pos+1:pos+2] == '#':
+                #a silent comment swallows every line indented below it
+                self.block = self.depth + 1
+                self.lexpos = self.line_end(data, pos)
+                self.begin('silent')
+                return None
+            t = self.make('SILENTSCRIPT', None, pos, pos + 1)
+            t.value = read_script(t)
+            return t
+        elif c == '%':
+            m = tagname_re.match(data, pos)
+            if m:
+                self.begin('tag')
+                return self.make('TAGNAME', m.group()[1:], pos, m.end())
+        elif c == '#' or c == '.':
+            m = (id_re if c == '#' else classname_re).match(data, pos)
+            if m:
+                self.begin('tag')
+                return self.make(c == '#' and 'ID' or 'CLASSNAME',
+                    m.group()[1:], pos, m.end())
+        elif c == '!' and data.startswith('!!!', pos):
+            self.begin('doctype')
+            return self.make('DOCTYPE', '!!!', pos, pos + 3)
+        elif c == '/':
+            self.begin('comment')
+            m = condcomment_re.match(data, pos)
+            if m:
+                return self.make('CONDCOMMENT', m.group()[2:-1], pos, m.end())
+            return self.make('COMMENT', '/', pos, pos + 1)
+        elif c == ':':
+            end = self.line_end(data, pos)
+            if end > pos + 1:
+                #a filter takes every line indented below it as content
+                t = self.make('FILTER', (self.depth, data[pos+1:end]), pos, end)
+                self.block = self.depth + 1
+                self.begin('filter')
+                return t
+        if c in ' ~&!=':
+            t = self.script(data, pos)
+            if t is not None:
+                return t
+        return self.other(data, pos)
+
+    def lex_tag(self, data, pos):
+        c = data[pos]
+        if c in whitespace:
+            t = self.lf(data, pos)
+            if t is not None:
+                return t
+        if c == '#' or c == '.':
+            m = (id_re if c == '#' else classname_re).match(data, pos)
+            if m:
+                return self.make(c == '#' and 'ID' or 'CLASSNAME',
+                    m.group()[1:], pos, m.end())
+        elif c == '<' or c == '>':
+            end = pos + 1
+            if data[end:end+1] == (c == '<' and '>' or '<'):
+                end += 1
+            return self.make('TRIM', data[pos:end], pos, end)
+        if c in ' {':
+            m = dict_re.match(data, pos)
+            if m:
+                t = self.make('DICT', None, pos, m.end() - 1)
+                return read_dict(t)
+        if c in ' ~&!=':
+            t = self.script(data, pos)
+            if t is not None:
+                return t
+        if c in ' \t' or c not in not_tag_value:
+            m = tag_value_re.match(data, pos)
+            if m:
+                return self.value(self.make('VALUE', m.group(), pos, m.end()))
+        return self.other(data, pos)
+
+    def lex_doctype(self, data, pos):
+        c = data[pos]
+        if c in whitespace:
+            t = self.lf(data, pos)
+            if t is not None:
+                return t
+        if c == ' ':
+            m = xmltype_re.match(data, pos)
+            if m:
+                value = m.group().replace('XML', '', 1).strip()
+                return self.make('XMLTYPE', value, pos, m.end())
+            m = htmltype_re.match(data, pos)
+            if m:
+                return self.make('HTMLTYPE', m.group().strip(), pos, m.end())
+        return self.other(data, pos)
+
+    def lex_comment(self, data, pos):
+        if data[pos] in whitespace:
+            t = self.lf(data, pos)
+            if t is not None:
+                return t
+        end = self.line_end(data, pos)
+        return self.make('VALUE', data[pos:end].strip(), pos, end)
+
+    def blanklines(self, data, pos):
+        """Skips a newline and any blank lines after it."""
+        end = blanklines_re.match(data, pos).end()
+        self.lineno += data.count('\n', pos, end)
+        self.lexpos = end
+        return end
+
+    def lex_silent(self, data, pos):
+        if data[pos] == '\n':
+            self.blanklines(data, pos)
+            self.newline = True
+        else:
+            self.lexpos = self.line_end(data, pos)
+
+    def lex_filter(self, data, pos):
+        if data[pos] != '\n':
+            end = self.line_end(data, pos)
+            return self.make('FILTERCONTENT', data[pos:end], pos, end)
+        t = self.make('FILTERBLANKLINES', None, pos)
+        #the filter block may go on after blank lines of any indentation
+        m = blanklines_re.match(data, pos)
+        newlines = data.count('\n', pos, m.end())
+        t.value = newlines - 1
+        self.lineno += newlines
+        self.lexpos = m.end()
+        self.newline = True
+        if t.value > 0:
+            return t
+
+    def lex_multi(self, data, pos):
+        if data[pos] == '\n':
+            self.blanklines(data, pos)
+            return None
+        end = self.line_end(data, pos)
+        value = data[pos:end].strip()
+        if value[-2:] in ('\t|',' |'):
+            return self.make('VALUE', value[:-1].strip(), pos, end)
+        #the first line without a | ends the value
+        self.begin('INITIAL')
+        self.newline = True
+        return self.make('LF', '\n', pos)
@@ -0,0 +1,55 @@
+import linecache
+from array import array
+
+from parser import get_line
+
+class LineMap(object):
+    """
+Maps the line numbers of generated Python code to the Haml line numbers that
+produced them.  Line numbers are kept in an array; the Haml text itself is only
+read from the source when it is asked for, which normally means an error is
+being reported.
+    """
+
+    def __init__(self, filename, source=None):
+        """
+Initializes a LineMap.  Arguments:
+
+filename: the name of the Haml file.  If source is None, Haml text is read
+from this file through linecache.
+
+source: the Haml source as a string, or a callable returning it.
+        """
+        self.filename = filename
+        self.source = source
+        #there is no Python line 0
+        self.lines = array('i', [0])
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __getitem__(self, python_line):
+        """
+Returns the Haml line number that produced python_line, or -1 if it is not
+known.
+        """
+        if 0 < python_line < len(self.lines):
+            return self.lines[python_line]
+        return -1
+
+    def append(self, haml_line, count=1):
+        """
+Records that the next count Python lines were produced by Haml line haml_line.
+        """
+        self.lines.extend(array('i', [haml_line]) * count)
+
+    def text(self, haml_line):
+        """
+Returns the text of a Haml line, fetching it from the source.
+        """
+        if self.source is None:
+            line = linecache.getline(self.filename, haml_line)
+            return line.rstrip('\r\n') or '<unknown HAML line>'
+        if callable(self.source):
+            self.source = self.source()
+        return get_line(self.source, haml_line)
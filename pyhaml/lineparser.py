@@ -0,0 +1,223 @@
+from lexer import HamlParserException
+from parser import (Tag, Content, Script, SilentScript, Doctype, Comment,
+    filters, p_error)
+
+#tokens that begin a Haml object
+starts = frozenset([
+    'TAGNAME',
+    'ID',
+    'CLASSNAME',
+    'FILTER',
+    'VALUE',
+    'COMMENT',
+    'CONDCOMMENT',
+    'DOCTYPE',
+    'SCRIPT',
+    'SILENTSCRIPT',
+])
+
+#tokens that may follow a complete object
+follow = starts | frozenset(['LF', '$end'])
+
+class End(object):
+    """The token returned once the lexer has no more tokens."""
+    type = '$end'
+
+end = End()
+
+class LineParser(object):
+    """
+Builds HamlObjs from Haml tokens without PLY.  The grammar in parser.py only
+describes a flat sequence of objects; nesting is left to HamlObj.add and the
+lexer's depth.  So this reads one object at a time with a single token of
+lookahead, and adds it to the node tree at the same point the LALR parser
+would reduce it, when the lexer has read the token after it.
+
+Syntax errors are reported through parser.p_error and recovered from like PLY
+does without error rules: the unfinished object and the offending token are
+dropped, and errors within the next three tokens are not reported.
+
+Like the PLY parser, a LineParser holds the state of the parse (root, nodes,
+src and so on) for the HamlObjs it creates.
+    """
+
+    def parse(self, input, lexer, debug=0, tracking=0):
+        self.lexer = lexer
+        self.errorcount = 0
+        lexer.input(input)
+        t = self.shift()
+        after_obj = False
+        while t is not end:
+            if t.type == 'LF' and after_obj:
+                t = self.shift()
+                after_obj = False
+                continue
+            if t.type in starts:
+                obj, t = getattr(self, 'p_' + t.type.lower())(t)
+                if t.type in follow:
+                    depth = obj.haml_indent
+                    if depth == None:
+                        depth = lexer.depth
+                    obj.add(depth)
+                    after_obj = True
+                    continue
+            self.error(t)
+            t = lexer.token() or end
+            after_obj = False
+
+    def shift(self):
+        """Accepts the current token and returns the next one."""
+        if self.errorcount:
+            self.errorcount -= 1
+        return self.lexer.token() or end
+
+    def error(self, t):
+        if self.errorcount == 0:
+            #like PLY, tell p_error which lexer read the token
+            if not hasattr(t, 'lexer'):
+                t.lexer = self.lexer
+            p_error(t)
+        self.errorcount = 3
+
+    def position(self, first, last):
+        """
+Returns the posinfo of an object made of the tokens from first to last, like
+get_position_info.
+        """
+        if self.tracking:
+            return (first.lineno, first.lexpos, last.lexpos)
+        return (first.lineno, first.lexpos, first.lexpos)
+
+    def values(self, t):
+        """
+Reads one or more VALUE tokens.  Returns their joined value, the last of them
+and the token after them.
+        """
+        values = [t.value]
+        last = t
+        t = self.shift()
+        while t.type == 'VALUE':
+            values.append(t.value)
+            last = t
+            t = self.shift()
+        return ' '.join(values), last, t
+
+    def p_script(self, t):
+        script_type, script = t.value
+        if self.op.suppress_eval:
+            script = '""'
+        obj = Script(self, posinfo=self.position(t, t), type=script_type,
+            value=script)
+        return obj, self.shift()
+
+    def p_silentscript(self, t):
+        first = t
+        t = self.shift()
+        if t.type in follow and self.op.suppress_eval:
+            raise HamlParserException, (
+                first.lineno, first.lexpos, 'python evaluation is not allowed')
+        return SilentScript(self, posinfo=self.position(first, first),
+            value=first.value), t
+
+    def p_filter(self, t):
+        first = t
+        haml_indent, filter_name = t.value
+        t = self.shift()
+        if not t.type in follow and \
+           not t.type in ('FILTERCONTENT', 'FILTERBLANKLINES'):
+            return None, t
+        if not filter_name in filters:
+            raise HamlParserException, (
+                first.lineno, first.lexpos, 'Invalid filter: %s' % filter_name)
+        obj = filters[filter_name](self, posinfo=self.position(first, first),
+            haml_indent=haml_indent)
+        while t.type in ('FILTERCONTENT', 'FILTERBLANKLINES'):
+            if t.type == 'FILTERBLANKLINES':
+                #count of blank lines
+                obj.lines.extend([''] * t.value)
+            else:
+                obj.lines.append(t.value)
+            t = self.shift()
+        return obj, t
+
+    def p_value(self, t):
+        first = t
+        value, last, t = self.values(t)
+        return Content(self, value, posinfo=self.position(first, last)), t
+
+    def p_doctype(self, t):
+        first = last = t
+        t = self.shift()
+        type = None
+        if t.type in ('HTMLTYPE', 'XMLTYPE'):
+            last = t
+            type = t
+            t = self.shift()
+        obj = Doctype(self, posinfo=self.position(first, last))
+        if type is not None:
+            obj.type = type.value
+            if type.type == 'XMLTYPE':
+                obj.type = type.value or 'utf-8'
+                obj.xml = True
+        return obj, t
+
+    def p_comment(self, t):
+        first = last = t
+        t = self.shift()
+        value = None
+        if t.type == 'VALUE':
+            last = t
+            value = t.value
+            t = self.shift()
+        if first.type == 'CONDCOMMENT':
+            obj = Comment(self, posinfo=self.position(first, last),
+                condition=first.value)
+        else:
+            obj = Comment(self, posinfo=self.position(first, last))
+        if value is not None:
+            obj.value = value
+        return obj, t
+
+    p_condcomment = p_comment
+
+    def p_tagname(self, t):
+        first = last = t
+        t = self.shift()
+        id = None
+        if first.type == 'TAGNAME' and t.type == 'ID':
+            last = t
+            id = t.value
+            t = self.shift()
+        obj = Tag(self, posinfo=self.position(first, last))
+        if first.type == 'TAGNAME':
+            obj.tagname = first.value
+            if id is not None:
+                obj.id = id
+        elif first.type == 'ID':
+            obj.id = first.value
+        else:
+            obj.addclass(first.value)
+        while t.type == 'CLASSNAME':
+            obj.addclass(t.value)
+            t = self.shift()
+
+        obj.hash = '{}'
+        if t.type == 'DICT':
+            if not self.op.suppress_eval:
+                obj.hash = t.value
+            t = self.shift()
+        if t.type == 'TRIM':
+            obj.inner = '<' in t.value
+            obj.outer = '>' in t.value
+            t = self.shift()
+        if t.type == '/':
+            obj.selfclose = True
+            t = self.shift()
+        if t.type == 'VALUE':
+            obj.value, _, t = self.values(t)
+        elif t.type == 'SCRIPT':
+            obj.value, t = self.p_script(t)
+        return obj, t
+
+    p_id = p_tagname
+    p_classname = p_tagname
@@ -0,0 +1,176 @@
+"""
+Template loaders: where an Engine reads Haml templates from.  A loader maps
+template names to their source, and to a fingerprint that changes whenever the
+source does, which caches compare to find stale templates.  Names are paths
+separated by slashes; loaders other than the filesystem's accept any os.sep
+spelling of them too.  atomic_write writes the files compiled from templates.
+"""
+from __future__ import with_statement
+
+import os
+import zipfile
+import posixpath
+from contextlib import contextmanager
+
+@contextmanager
+def atomic_write(path, mode='wb'):
+    """
+Opens a temporary file next to path for writing, and renames it to path when
+the with block is done, so that readers never see half of the file.  The
+temporary file is removed if the block fails.
+    """
+    tmp = '%s.%d' % (path, os.getpid())
+    try:
+        with open(tmp, mode) as f:
+            yield f
+        os.rename(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+class TemplateLoader(object):
+    """The interface of template loaders."""
+
+    def get_source(self, name):
+        """Returns the Haml source of a template, or raises IOError."""
+        raise NotImplementedError
+
+    def fingerprint(self, name):
+        """
+Returns a value that changes whenever the source of a template does, or None if
+there is no such template.
+        """
+        raise NotImplementedError
+
+    def listdir(self, dir):
+        """
+Returns the names of the files in a directory of templates; '' is the top
+directory.
+        """
+        raise NotImplementedError
+
+def normalize(name):
+    """Returns a template name with / separators and no . or .. parts."""
+    name = posixpath.normpath(name.replace(os.sep, '/')).lstrip('/')
+    if name == '.':
+        return ''
+    return name
+
+def children(names, dir):
+    """
+Returns the names of the files and directories right inside a directory, given
+the names of every template.
+    """
+    prefix = dir and dir + '/'
+    return list(set(name[len(prefix):].split('/')[0] for name in names
+        if name.startswith(prefix) and len(name) > len(prefix)))
+
+class FileSystemLoader(TemplateLoader):
+    """
+Reads templates from files.  Names are file paths, relative to root if it is
+given.
+    """
+
+    def __init__(self, root=None):
+        self.root = root
+
+    def path(self, name):
+        if self.root is None:
+            return name
+        return os.path.join(self.root, name)
+
+    def get_source(self, name):
+        with open(self.path(name), 'rb') as f:
+            return f.read()
+
+    def fingerprint(self, name):
+        try:
+            stat = os.stat(self.path(name))
+        except OSError:
+            return None
+        return (stat.st_mtime, stat.st_size)
+
+    def listdir(self, dir):
+        try:
+            return os.listdir(self.path(dir) or os.curdir)
+        except OSError:
+            return []
+
+class DictLoader(TemplateLoader):
+    """Reads templates from a dictionary of names to sources."""
+
+    def __init__(self, templates):
+        self.templates = templates
+
+    def get_source(self, name):
+        try:
+            return self.templates[normalize(name)]
+        except KeyError:
+            raise IOError('no template %s' % name)
+
+    def fingerprint(self, name):
+        source = self.templates.get(normalize(name))
+        if source is None:
+            return None
+        #the hash of a str is only computed once
+        return (len(source), hash(source))
+
+    def listdir(self, dir):
+        return children(self.templates, normalize(dir))
+
+class ZipLoader(TemplateLoader):
+    """
+Reads templates from a zip archive, such as a wheel or a zipapp, without
+unpacking it.  Names are relative to the directory prefix in the archive.
+    """
+
+    def __init__(self, archive, prefix=''):
+        self.archive = archive
+        self.prefix = normalize(prefix)
+        self.zip = zipfile.ZipFile(archive)
+
+    def member(self, name):
+        return normalize(posixpath.join(self.prefix, normalize(name)))
+
+    def get_source(self, name):
+        try:
+            return self.zip.read(self.member(name))
+        except KeyError:
+            raise IOError('no template %s in %s' % (name, self.archive))
+
+    def fingerprint(self, name):
+        try:
+            info = self.zip.getinfo(self.member(name))
+        except KeyError:
+            return None
+        return (info.CRC, info.file_size, info.date_time)
+
+    def listdir(self, dir):
+        return children(self.zip.namelist(), self.member(dir))
+
+class PackageLoader(TemplateLoader):
+    """
+Reads templates from a directory of a Python package, whether the package is
+installed in a directory or imported from a zip archive.
+    """
+
+    def __init__(self, package, dir='templates'):
+        module = __import__(package, fromlist=['__name__'])
+        root = os.path.join(os.path.dirname(module.__file__), dir)
+        loader = getattr(module, '__loader__', None)
+        if hasattr(loader, 'archive'):
+            #a zipimporter: the package's path in the archive follows the
+            #archive's own path
+            prefix = root[len(loader.archive):]
+            self.loader = ZipLoader(loader.archive, prefix)
+        else:
+            self.loader = FileSystemLoader(root)
+
+    def get_source(self, name):
+        return self.loader.get_source(name)
+
+    def fingerprint(self, name):
+        return self.loader.fingerprint(name)
+
+    def listdir(self, dir):
+        return self.loader.listdir(dir)
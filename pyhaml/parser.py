@@ -1,7 +1,6 @@
-import logging
-import haml
-from lexer import tokens, HamlParserException
-from patch import toks, untokenize
+import re
+from tokenize import TokenError
+from lexer import tokens, HamlParserException, Diagnostic, scan_python
 import markdown
 
 doctypes = {
@@ -39,6 +38,9 @@ doctypes = {
 doctypes['xhtml'][''] = doctypes['xhtml']['transitional']
 doctypes['html4'][''] = doctypes['html4']['transitional']
 
+#the start of inline Python, and the backslashes that may escape it
+inline_python = re.compile(r'(\\*)@\{')
+
 class HamlCall(object):
     """
 Represents a single compiled Python statement.  As the name of this class
@@ -47,6 +49,8 @@ can also be a line of Python generated by - or =.  Calling str or repr on an
 instance of this class will convert it to Python code.
     """
 
+    __slots__ = ('haml', 'args', 'func', 'script', 'depth')
+
     def __init__(self, **kwargs):
         """
 Initializes a HamlCall.  Keyword arguments:
@@ -65,7 +69,8 @@ turn into.  If script is defined, func and args must not be defined.
         self.args = []
         self.func = None
         self.script = ''
-        self.__dict__.update(kwargs)
+        for (k,v) in kwargs.items():
+            setattr(self, k, v)
 
     def __repr__(self):
         """ Returns a compiled Python string representing this code.
@@ -84,6 +89,8 @@ class HamlObj(object):
 An element of the HAMl file (e.g. tag, script, filter).
     """
 
+    __slots__ = ('parser', 'src', 'posinfo', 'haml_indent', 'children')
+
     def __init__(self, parser, posinfo=None, haml_indent=None):
         """
 Initializes a HamlObj.  Argument:
@@ -92,7 +99,9 @@ parser: The PLY parser that produced this object.
 
 Keyword argument:
 
-posinfo: A tuple (lineno, text) of the sort produced by get_position_info.
+posinfo: A tuple (lineno, lexstart, lexend) of the sort produced by
+get_position_info.  The positions index into the source being parsed, and the
+HAML text is only looked up when it is needed (see haml_text).
 
 haml_indent: How far this HamlObj is indented in the HAML source code.  If it
 is None, it is assumed to be indented at lexer.depth at the time after reading
@@ -102,13 +111,32 @@ the object.
         self.parser = parser
         self.src = parser.src
         if posinfo is None:
-            posinfo = (self.parser.lineno, "<unknown HAML line>")
+            posinfo = (self.parser.lineno, -1, -1)
         self.posinfo = posinfo
         self.haml_indent = haml_indent
+        self.children = None
+
+    def add(self, depth):
+        """
+Add the object to the node tree, nested in the object that was last added at
+depth - 1.  This is called by the parser when the object is encountered; no
+code is generated until the tree is lowered (see ir.lower).
+        """
+        nodes = self.parser.nodes
+        del nodes[depth:]
+        if nodes:
+            parent = nodes[-1]
+            if parent.children is None:
+                parent.children = []
+            parent.children.append(self)
+        else:
+            self.parser.root.append(self)
+        nodes.append(self)
 
     def begin(self, depth):
         """
-Begin an object, which is indented to a certain depth.  This is called when the object is encountered.
+Begin an object, which is indented to a certain depth.  This is called when the
+object is lowered, or by other objects to open objects of their own.
         """
         #close things at a higher indentation than this
         while len(self.parser.to_close) > depth:
@@ -128,21 +156,9 @@ End an object.  This is called after all the object's nested objects are done.
     def call(self, **kwargs):
         """
 Add a call to the generated Python code.  Keyword arguments are passed to the
-HamlCall constructor.
+HamlCall constructor.  Calls are optimized afterwards by the passes in ir.
         """
-        last = self.src[-1] if len(self.src) else None
-        next = HamlCall(depth=self.parser.depth, haml=self, **kwargs)
-
-        if last != None and last.depth == next.depth:
-            #entab and detab cancel each other out
-            if next.func == 'detab' and last.func == 'entab':
-                return self.src.pop()
-            #merge multiple write calls into one
-            elif next.func == 'write':
-                if next.func == last.func:
-                    return last.args.extend(next.args)
-
-        self.src.append(next)
+        self.src.append(HamlCall(depth=self.parser.depth, haml=self, **kwargs))
 
     def push(self, s, **kwargs):
         """
@@ -159,67 +175,46 @@ returns the string.  This works like repr on strings without inline Python.
 Syntax for inline Python:
 
 some text @{python(code)} some more text
-=> "some text %s some more text" % (python(code))
-A backslash before the * escapes it.
+=> ''.join(('some text ', unicode((python(code))), ' some more text'))
+A backslash before the @ escapes it.
 some tex \@{not python some more text
-=> "some text \\@{not python some more text"
-        """
-        fmt = []
-        args = []
-        def add_literal(lit):
-            fmt.append(lit.replace("%", "%%"))
-
-        def read_script():
-            tokens = []
-            level = 0
-            rest = None
-            for tok in toks(s):
-                _, t, _, (_, col), _ = tok
-                if t == '{':
-                    level += 1
-                elif t == '}':
-                    if level == 0:
-                        rest = s[col:]
-                        break
-                    level -= 1
-                tokens.append(tok)
-            if rest == None:
-                #never reached break, so @{ was not closed with }
-                self.error("End of line reached when reading inline Python")
-            python_code = untokenize(tokens)
-            fmt.append("%s")
-            args.append("(%s)" % python_code)
-            return rest
-            
+=> 'some text @{not python some more text'
+        """
+        if not '@{' in s:
+            return repr(s)
+        parts = []
+        literal = []
+        pos = 0
         while True:
-            open_index = s.find("@{")
-            if open_index == -1:
-                add_literal(s)
+            m = inline_python.search(s, pos)
+            if not m:
+                literal.append(s[pos:])
                 break
-            backslashes = 0
-            for i in xrange(open_index - 1, 0, -1):
-                if s[i] == '\\':
-                    backslashes += 1
-                else:
-                    break
-            add_literal(s[:open_index - backslashes])
-            add_literal('\\' * (backslashes / 2))
-            s = s[open_index + 2:]
+            backslashes = len(m.group(1))
+            literal.append(s[pos:m.start()])
+            literal.append('\\' * (backslashes // 2))
+            pos = m.end()
             if backslashes % 2 == 1:
-                add_literal("@{")
-            else:
-                s = read_script()
-
-        fmt = "".join(fmt)
-        if len(args) == 0:
-            return repr(fmt.replace('%%', '%'))
-        else:
-            if len(args) == 1:
-                #in case eval(args[0]) is a tuple
-                args = args[0] + ","
-            else:
-                args = ", ".join(args)
-            return "%r %% (%s)" % (fmt, args)
+                literal.append('@{')
+                continue
+            try:
+                end = scan_python(s, pos, '}')
+            except TokenError:
+                self.error("End of line reached when reading inline Python")
+            literal = ''.join(literal)
+            if literal:
+                parts.append(repr(literal))
+            #parenthesized, in case the code is a tuple
+            parts.append('unicode((%s))' % s[pos:end])
+            literal = []
+            pos = end + 1
+
+        literal = ''.join(literal)
+        if literal or not parts:
+            parts.append(repr(literal))
+        if len(parts) == 1:
+            return parts[0]
+        return "''.join((%s))" % ', '.join(parts)
 
     def write(self, s, literal=False, escape=False, preserve_whitespace=False):
         """
@@ -331,15 +326,26 @@ ensure that no objects were nested in this one.
         if not self.parser.last_obj is self:
             self.error('illegal nesting')
 
+    def haml_text(self):
+        """
+Returns the HAML code this object was parsed from.
+        """
+        (_, lexstart, lexend) = self.posinfo
+        if lexstart < 0:
+            return "<unknown HAML line>"
+        return get_lines_in_position_range(self.parser.source, lexstart, lexend)
+
     def error(self, msg):
         """
 Raises a HamlParserException.  The exception will contain the line number and
 HAML code of this object for better error reporting.
         """
-        raise HamlParserException, (self.posinfo[0], self.posinfo[1], msg)
+        raise HamlParserException, (self.posinfo[0], self.haml_text(), msg)
 
 class Filter(HamlObj):
 
+    __slots__ = ('lines',)
+
     def __init__(self, parser, **kwargs):
         HamlObj.__init__(self, parser, **kwargs)
         self.lines = []
@@ -350,6 +356,8 @@ class Filter(HamlObj):
 
 class CData(HamlObj):
 
+    __slots__ = ()
+
     def open(self):
         self.push('//<![CDATA[', literal=True)
 
@@ -358,6 +366,8 @@ class CData(HamlObj):
 
 class JavascriptFilter(Filter):
 
+    __slots__ = ()
+
     def open(self):
         depth = len(self.parser.to_close)
         Tag(self.parser, posinfo=self.posinfo, tagname='script',
@@ -369,12 +379,16 @@ class JavascriptFilter(Filter):
 
 class EscapedFilter(Filter):
 
+    __slots__ = ()
+
     def open(self):
         for l in self.lines:
             self.push(l, literal=True, escape=True)
 
 class MarkdownFilter(Filter):
-    
+
+    __slots__ = ()
+
     def open(self):
         code = '\n'.join(self.lines)
         html = markdown.markdown(code)
@@ -383,6 +397,8 @@ class MarkdownFilter(Filter):
 
 class Content(HamlObj):
 
+    __slots__ = ('value',)
+
     def __init__(self, parser, value, **kwargs):
         HamlObj.__init__(self, parser, **kwargs)
         self.value = value
@@ -395,6 +411,8 @@ class Content(HamlObj):
 
 class Script(HamlObj):
 
+    __slots__ = ('type', 'value', 'escape', 'preserve_whitespace')
+
     def __init__(self, parser, type='=', value='', **kwargs):
         HamlObj.__init__(self, parser, **kwargs)
         self.type = type
@@ -417,6 +435,8 @@ class Script(HamlObj):
 
 class SilentScript(HamlObj):
 
+    __slots__ = ('value',)
+
     def __init__(self, parser, value='', **kwargs):
         HamlObj.__init__(self, parser, **kwargs)
         self.value = value
@@ -436,6 +456,8 @@ class SilentScript(HamlObj):
 
 class Doctype(HamlObj):
 
+    __slots__ = ('xml', 'type')
+
     def __init__(self, parser, **kwargs):
         HamlObj.__init__(self, parser, **kwargs)
         self.xml = False
@@ -454,6 +476,8 @@ class Doctype(HamlObj):
 
 class Comment(HamlObj):
 
+    __slots__ = ('value', 'condition')
+
     def __init__(self, parser, value='', condition='', **kwargs):
         HamlObj.__init__(self, parser, **kwargs)
         self.value = value.strip()
@@ -480,6 +504,9 @@ class Comment(HamlObj):
 
 class Tag(HamlObj):
 
+    __slots__ = ('hash', 'id', 'klass', 'value', 'tagname', 'inner', 'outer',
+        'selfclose')
+
     def __init__(self, parser, hash='', id='', klass='', value=None, 
                  tagname='div', inner=False, outer=False, selfclose=False,
                  **kwargs):
@@ -546,6 +573,13 @@ class Tag(HamlObj):
             s = '</' + self.tagname + '>'
         self.push(s, closing=True, literal=True)
 
+filters = {
+    'plain': Filter,
+    'javascript': JavascriptFilter,
+    'escaped': EscapedFilter,
+    'markdown': MarkdownFilter,
+}
+
 def get_lines_in_position_range(lexdata, lexstart, lexend):
     """
 Given a string, a starting position, and an ending position, this function grabs
@@ -553,25 +587,36 @@ enough lines to ensure that both the starting and ending positions are included.
 Returns a substring of lexdata containing a number of complete lines, with the
 first and last newline characters omitted.
     """
-    start_line_pos = lexdata.rfind('\n', 0, lexstart)
-    if start_line_pos == -1: start_line_pos = 0
+    start_line_pos = lexdata.rfind('\n', 0, lexstart) + 1
     end_line_pos = lexdata.find('\n', lexend)
     if end_line_pos == -1: end_line_pos = len(lexdata) 
-    return lexdata[start_line_pos + 1 : end_line_pos]
+    return lexdata[start_line_pos : end_line_pos]
+
+def get_line(lexdata, lineno):
+    """
+Returns line number lineno (counting from 1) of a string, without its newline,
+or a placeholder if the string has no such line.
+    """
+    lines = lexdata.split('\n')
+    if 0 < lineno <= len(lines):
+        return lines[lineno - 1]
+    return '<unknown HAML line>'
 
 def get_position_info(p):
-    """Given a parsing context, get the line number and text of the current symbol.  Returned in a tuple (line, text)."""
-    line = p.lineno(0)
-    (lexstart, lexend) = p.lexspan(0)
-    return (line, get_lines_in_position_range(p.lexer.lexdata, lexstart, lexend))
+    """Given a parsing context, get the line number and position range of the current symbol.  Returned in a tuple (line, lexstart, lexend).
+Without tracking only the position of the first symbol is known, which every
+production calling this either is a token or carries itself (see p_value)."""
+    if p.parser.tracking:
+        (lexstart, lexend) = p.lexspan(0)
+        return (p.lineno(0), lexstart, lexend)
+    lexstart = p.lexpos(1)
+    return (p.lineno(1), lexstart, lexstart)
 
 def p_haml_doc(p):
     '''haml :
             | doc
             | doc LF'''
-    #this code is reached at the end of parsing, so close all unclosed objects
-    while len(p.parser.to_close):
-        p.parser.to_close.pop().end()
+    pass
 
 def p_doc(p):
     '''doc : obj
@@ -591,24 +636,18 @@ def p_obj(p):
     depth = p[1].haml_indent
     if depth == None:
         depth = p.lexer.depth
-    p[1].begin(depth)
+    p[1].add(depth)
 
 def p_filter(p):
     '''filter : filter FILTERCONTENT
                 | filter FILTERBLANKLINES
                 | FILTER'''
     if len(p) == 2:
-        types = {
-            'plain': Filter,
-            'javascript': JavascriptFilter,
-            'escaped': EscapedFilter,
-            'markdown': MarkdownFilter,
-        }
         haml_indent, filter_name = p[1]
-        if not filter_name in types:
+        if not filter_name in filters:
             raise HamlParserException, (
                 p.lineno(0), p.lexpos(0), 'Invalid filter: %s' % filter_name)
-        p[0] = types[filter_name](p.parser, posinfo=get_position_info(p),
+        p[0] = filters[filter_name](p.parser, posinfo=get_position_info(p),
 haml_indent = haml_indent)
     elif len(p) == 3:
         p[0] = p[1]
@@ -706,6 +745,10 @@ def p_value(p):
         p[0] = p[1]
     elif len(p) == 3:
         p[0] = '%s %s' % (p[1], p[2])
+    if not p.parser.tracking:
+        #carry the position of the first VALUE for get_position_info
+        p.set_lineno(0, p.lineno(1))
+        p.slice[0].lexpos = p.lexpos(1)
 
 def p_dict(p):
     '''dict :
@@ -742,13 +785,11 @@ def p_tag_tag_class(p):
     p[0].addclass(p[2])
 
 def p_error(p):
-    msg = "syntax error %s [%s] file: %s lineno: %s\n" % (
-        p,
-        p.value[:80],
-        haml.eng.op.filename,
-        p.lineno
-    )
-    if haml.eng.op.fail_fast:
-      raise Exception(msg)
-    else:
-      logging.warning(msg)
+    """
+Records a syntax error as a Diagnostic on the lexer that read the token, or
+raises it if the fail_fast option is set.
+    """
+    d = Diagnostic(p.lineno, p.lexpos, str(p.value), 'syntax error %s' % p)
+    if p.lexer.op is not None and p.lexer.op.fail_fast:
+        raise HamlParserException, (p.lineno, p.lexpos, str(d))
+    p.lexer.diagnostics.append(d)
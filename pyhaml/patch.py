@@ -1,7 +1,6 @@
 from __future__ import division
 
 import sys
-import tokenize
 
 if sys.version_info[0] >= 3:
     import io
@@ -9,19 +8,19 @@ if sys.version_info[0] >= 3:
     
     raw_input = input
     StringIO = io.StringIO
-    
-    def toks(s):
-        g = io.BytesIO(bytes(s.encode())).readline
-        return (t for t in tokenize.tokenize(g))
-    
-    def untokenize(toks):
-        return tokenize.untokenize(toks).decode()
 else:
     from patch2 import ex
     from StringIO import StringIO
-    
-    def toks(s):
-        return tokenize.generate_tokens(StringIO(s).readline)
-    
-    def untokenize(toks):
-        return tokenize.untokenize(toks)
+
+try:
+    import json
+except ImportError:
+    #Python 2.5 only has it as simplejson, if that is installed.  Without it
+    #there is no ir_cache, and batch compiles keep no manifest.
+    try:
+        import simplejson as json
+    except ImportError:
+        json = None
+
+#Python 2.5 always writes bytecode
+dont_write_bytecode = lambda: getattr(sys, 'dont_write_bytecode', False)
@@ -175,7 +175,8 @@ def format_stack_entry(r):
 #        .lexpos     = Starting lex position
 #        .endlexpos  = Ending lex position (optional, set automatically)
 
-class YaccSymbol:
+class YaccSymbol(object):
+    __slots__ = ('type','value','lineno','lexpos','endlineno','endlexpos','lexer')
     def __str__(self):    return self.type
     def __repr__(self):   return str(self)
 
@@ -0,0 +1,140 @@
+import dis
+import types
+import weakref
+from collections import deque
+
+#what the top level of a reusable module may do besides loading _haml and
+#calling _haml.imp or _haml.linked: define functions from constants, import
+#modules, bind names and run the blocks of an incremental compile
+plain_ops = set(dis.opmap[name] for name in ('LOAD_CONST', 'MAKE_FUNCTION',
+    'STORE_NAME', 'IMPORT_NAME', 'IMPORT_FROM', 'IMPORT_STAR', 'POP_TOP',
+    'DUP_TOP', 'RETURN_VALUE') if name in dis.opmap)
+
+def reusable(code):
+    """
+Returns whether the top level of a module's code only defines functions,
+imports modules and binds names to them, so that running it again in another
+render would make the same module.  Anything else, such as writing HTML or
+reading the render's arguments, makes a module run on every import.
+    """
+    ops = dis.opmap
+    #the _haml.imp and _haml.linked calls not made yet, and the code of the
+    #block an exec statement runs
+    (pending, block) = (0, None)
+    last = None
+    co = code.co_code
+    i = 0
+    while i < len(co):
+        op = ord(co[i])
+        if op >= dis.HAVE_ARGUMENT:
+            arg = ord(co[i + 1]) + ord(co[i + 2]) * 256
+            i += 3
+        else:
+            i += 1
+        if last == ops['LOAD_NAME'] and op != ops['LOAD_ATTR']:
+            return False
+        if op == ops['LOAD_NAME']:
+            if code.co_names[arg] != '_haml':
+                return False
+        elif op == ops['LOAD_ATTR']:
+            if last != ops['LOAD_NAME'] or \
+               not code.co_names[arg] in ('imp', 'linked'):
+                return False
+            pending += 1
+        elif op == ops['CALL_FUNCTION']:
+            if not pending:
+                return False
+            pending -= 1
+        elif op == ops.get('EXEC_STMT'):
+            if block is None or not reusable(block):
+                return False
+            block = None
+        elif not op in plain_ops:
+            return False
+        elif op == ops['LOAD_CONST'] and \
+             isinstance(code.co_consts[arg], types.CodeType):
+            block = code.co_consts[arg]
+        elif op == ops['MAKE_FUNCTION']:
+            block = None
+        last = op
+    return True
+
+class HamlModule(types.ModuleType):
+    """
+An imported Haml file.  Unlike plain modules, these can be weakly referenced.
+A module holds on to the modules it imported while it ran: once a module is
+reclaimed its globals are cleared, which would break the functions a module
+imported from it.
+    """
+
+    __slots__ = ('imported', '__weakref__')
+
+    def __init__(self, name):
+        types.ModuleType.__init__(self, name)
+        self.imported = []
+
+class ModuleRegistry(object):
+    """
+Keeps the Haml modules an engine imported, by path, instead of sys.modules.  The
+size most recently used modules are held on to, and the rest are forgotten as
+soon as nothing else holds on to them, such as a module that imported them or
+the template being rendered, so that the modules and the render arguments in
+their globals can be reclaimed.
+    """
+
+    def __init__(self, size=128):
+        self.size = size
+        self.clear()
+
+    def clear(self):
+        #the modules held on to by path, and their paths, least recently used
+        #first
+        self.recent = {}
+        self.order = deque()
+        #every module still alive, and its key, the names it defined and the
+        #names the last render that ran or reused it handed it
+        self.modules = weakref.WeakValueDictionary()
+        self.entries = weakref.WeakKeyDictionary()
+
+    def __len__(self):
+        return len(self.modules)
+
+    def __contains__(self, path):
+        return path in self.modules
+
+    def get(self, path):
+        """
+Returns the entry (key, module, names the module defined itself, names it was
+handed) of a path, or None, and marks it as the most recently used.  The last
+two are sets, which the caller may change.
+        """
+        mod = self.modules.get(path)
+        if mod is None:
+            return None
+        self.use(path, mod)
+        (key, defined, given) = self.entries[mod]
+        return (key, mod, defined, given)
+
+    def put(self, path, key, mod, defined, given):
+        self.modules[path] = mod
+        self.entries[mod] = (key, defined, given)
+        self.use(path, mod)
+
+    def pop(self, path):
+        if self.recent.pop(path, None) is not None:
+            self.order.remove(path)
+        mod = self.modules.pop(path, None)
+        if mod is not None:
+            self.entries.pop(mod, None)
+
+    def use(self, path, mod):
+        """
+Holds on to the module of a path as the most recently used, and lets go of the
+least recently used ones beyond size.
+        """
+        if path in self.recent:
+            self.order.remove(path)
+        self.recent[path] = mod
+        self.order.append(path)
+        while len(self.order) > self.size:
+            del self.recent[self.order.popleft()]
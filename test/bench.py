@@ -0,0 +1,118 @@
+"""
+Compile benchmarks for pyhaml.  Run as
+
+    python test/bench.py [name ...]
+
+to run all benchmarks, or only the named ones.  Every benchmark runs in a fresh
+interpreter so that peak memory figures are not polluted by earlier runs.
+"""
+from __future__ import with_statement
+import os
+import sys
+import time
+import resource
+import subprocess
+
+dir = os.path.dirname(os.path.abspath(__file__))
+parent = os.path.dirname(dir)
+sys.path.insert(0, parent)
+sys.path.insert(0, os.path.join(parent, 'pyhaml'))
+
+def template(n):
+    """Returns a synthetic template of roughly n lines."""
+    lines = ['!!!', '%html', '  %body']
+    i = 0
+    while len(lines) < n:
+        lines += [
+            '    -for x in range(%d):' % (i % 7),
+            '      %%div#item%d.row{ "data-x": x }' % i,
+            '        %%span.label item @{x} of %d' % i,
+            '        %p= x * 2',
+            '        -# a comment',
+            '        plain text line %d' % i,
+        ]
+        i += 1
+    return '\n'.join(lines)
+
+def peak_rss():
+    """Returns the peak resident set size of this process in kilobytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def timed(f, *args):
+    start = time.time()
+    f(*args)
+    return time.time() - start
+
+def bench_compile():
+    """Time and peak memory of compiling a 10k line template."""
+    from pyhaml.haml import eng
+    eng.setops()
+    s = template(10000)
+    before = peak_rss()
+    t = timed(eng.compile, s)
+    return 'compile 10k lines: %.3fs, peak rss +%dkB' % (t, peak_rss() - before)
+
+def bench_scaling():
+    """Compile time per line as script heavy templates grow; flat means linear."""
+    from pyhaml.haml import eng
+    eng.setops()
+    results = []
+    for n in (2500, 5000, 10000, 20000):
+        s = '\n'.join(i % 2 and '%%p= x%d' % i or '%p ' + 'lorem ipsum ' * 20
+            for i in range(n))
+        t = timed(eng.compile, s)
+        results.append('%d lines %.1fus/line' % (n, t / n * 1e6))
+    return 'scaling: ' + ', '.join(results)
+
+def bench_incremental():
+    """Recompiling a 5k line template after a one line edit."""
+    from pyhaml.haml import eng
+    s = '\n'.join(line.strip() and line[4:] or line
+        for line in template(5000).split('\n')[3:])
+    edited = s.replace('item 0 of', 'edited item 0 of')
+    results = []
+    for incremental in (False, True):
+        eng.setops(incremental=incremental)
+        eng.compile(s, 'bench.haml')
+        results.append(timed(eng.compile, edited, 'bench.haml'))
+    return 'recompile 5k lines after an edit: full %.3fs, incremental %.3fs' % \
+        tuple(results)
+
+def bench_ir():
+    """Compiling a 10k line template from its intermediate code."""
+    import shutil
+    import tempfile
+    from pyhaml.haml import eng
+    cache = tempfile.mkdtemp()
+    try:
+        p = os.path.join(cache, 'bench.haml')
+        with open(p, 'w') as f:
+            f.write(template(10000))
+        eng.setops(ir_cache=cache)
+        full = timed(eng._compile_ir, p)
+        loaded = timed(eng._compile_ir, p)
+    finally:
+        shutil.rmtree(cache)
+    return 'compile 10k lines: full %.3fs, from intermediate code %.3fs' % (
+        full, loaded)
+
+benchmarks = [
+    bench_compile,
+    bench_scaling,
+    bench_incremental,
+    bench_ir,
+]
+
+def main(names):
+    if names[:1] == ['--run']:
+        f = dict((f.__name__, f) for f in benchmarks)[names[1]]
+        sys.stdout.write(f() + '\n')
+        return
+    for f in benchmarks:
+        if names and not f.__name__[len('bench_'):] in names:
+            continue
+        subprocess.call([sys.executable, os.path.abspath(__file__),
+            '--run', f.__name__])
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,8 +1,14 @@
 from __future__ import with_statement
 import os
 import sys
+import gc
 import difflib
+import shutil
+import tempfile
+import zipfile
 import unittest
+import threading
+from contextlib import closing
 from functools import partial
 from optparse import OptionValueError
 
@@ -12,11 +18,93 @@ sys.path.insert(0, parent)
 sys.path.insert(0, os.path.join(parent, 'pyhaml'))
 
 from pyhaml.patch import StringIO
-from pyhaml.parser import doctypes
-from pyhaml.haml import to_html, render
+from pyhaml.parser import doctypes, HamlCall, Tag
+from pyhaml.ply.lex import LexToken
+from pyhaml.lexer import scan_python
+from pyhaml.linelexer import LineLexer
+from pyhaml.ir import (cancel_tabs, merge_writes, inline_defs, required,
+    profiles, dump, load)
+from pyhaml.index import TemplateIndex
+from pyhaml.loaders import (FileSystemLoader, DictLoader, ZipLoader,
+    atomic_write)
+from pyhaml.bundle import Bundle, build, templates
+from pyhaml import batch
+from pyhaml.haml import (to_html, render, eng, Engine, Finder, Loader,
+    HamlException, finder)
+
+#templates whose token streams are compared between the lexer backends
+corpus = [
+    '!!!', '!!! XML', '!!! XML iso-8859-1', '!!! strict', '!!!\n%html',
+    '%p foo', '%p\n  %a bar\n  baz', '%p.foo#bar.baz{ "a": 1 }/',
+    '%p<>= x', '%p><', '%p\t\\= foo', '#foo\n.bar baz', '%a:b_c-d',
+    '%p{ "a":\n  1 }\n  %b', '%p = 3\n%p != "<"\n%p &= "&"\n%p ~ "a"',
+    '- for i in range(3):\n  %p= i', '-def f(x):\n  = x\n-f(1)',
+    '-# comment\n  hidden\n\n    more\n%p', '%p\n  -# a\n    b\n  %p',
+    '/ comment\n/\n  %p', '/[if IE]\n  %p', '%p multi |\n  %line |\n  x |\n%p',
+    '%p\n multi |\n line |\n%p', '%p multi |\n  \n line |\n',
+    ':plain\n  foo\n    bar\n\n\n  baz\n%div', ':plain', ':javascript\n\tvar foo;',
+    '%p\r\n  %a\r\n  \\-x\r\n', '%p\n\t%p', '%p\n  %p\n\t\t%p', ':',
+    '&x', '%p %', '.', "= '''a\nb'''\n%p", '%p= [1,\n  2]\n%p',
+]
+
+def tokens(lexer, s):
+    """Returns every token lexer reads from s, with the lexer's depth after
+reading it, followed by the illegal characters it found."""
+    lexer.begin('INITIAL')
+    lexer.__dict__.update(depth=0, type=None, length=None, block=None, lineno=1,
+        op=None, diagnostics=[])
+    lexer.input(s)
+    result = []
+    try:
+        for t in iter(lexer.token, None):
+            result.append((t.type, t.value, t.lineno, t.lexpos, lexer.depth))
+    except Exception:
+        result.append(sys.exc_info()[1].args)
+    return result + [(d.lineno, d.lexpos, d.text) for d in lexer.diagnostics]
+
+def samples():
+    """Returns the corpus and the source of every Haml file in test/haml.  The
+directory also holds the __pycache__ of the templates the tests import."""
+    templates = list(corpus)
+    for name in sorted(os.listdir(os.path.join(dir, 'haml'))):
+        if name.endswith('.haml'):
+            with open(os.path.join(dir, 'haml', name)) as f:
+                templates.append(f.read())
+    return templates
+
+def source(s, **kwargs):
+    """Returns the Python source generated for s, and the Haml line of each
+statement."""
+    eng.setops(**kwargs)
+    try:
+        return [(str(call), call.haml.posinfo) for call in eng._parse(s).src]
+    except Exception:
+        return sys.exc_info()[1].args
 
 class TestHaml(unittest.TestCase):
     
+    def setUp(self):
+        #the temporary directory of the test's templates, made by write
+        self.tmp = None
+    
+    def tearDown(self):
+        if self.tmp is not None:
+            shutil.rmtree(self.tmp)
+    
+    def write(self, name, s, mtime=None):
+        """Writes a template to the test's temporary directory, returning its
+path."""
+        if self.tmp is None:
+            self.tmp = tempfile.mkdtemp()
+        path = os.path.join(self.tmp, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(s)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+    
     def diff(self, s, *args):
         p = os.path.join(dir, 'haml/%s.haml' % s)
         s1 = StringIO(render(p, *args)).readlines()
@@ -117,6 +205,35 @@ class TestHaml(unittest.TestCase):
         self.assertEqual('<p>foo\nbar</p>\n', to_html("%p='''foo\nbar'''"))
         self.assertEqual('<p>multiline</p>\n', to_html("%p=('multi'\n'line')"))
     
+    def testscriptcontinuation(self):
+        self.assertEqual('<p>3</p>\n', to_html('-x = 1 + \\\n  2\n%p= x'))
+        self.assertEqual('#\n', to_html('-y = ("#" # a comment\n  )\n= y # another'))
+        self.assertEqual("<p a='}'></p>\n", to_html('%p{"a": "}", # c\n }', attr_wrapper="'"))
+    
+    def testscanpython(self):
+        self.assertEqual(10, scan_python('x = (1,\n2)\ny', 0))
+        self.assertEqual(7, scan_python("{'}': 1}", 1, '}'))
+        self.assertEqual(13, scan_python("x = '''a\nb'''", 0))
+        self.assertEqual(6, scan_python("x = 'a\nb", 0))
+        self.assertRaises(Exception, partial(scan_python, 'x = (1,\n', 0))
+        self.assertRaises(Exception, partial(scan_python, "x = '''a", 0))
+    
+    def testscriptsource(self):
+        eng.setops()
+        eng.compile('- x = [1, \\\n  2]\t# keep\n%p= x')
+        self.assertEqual('x = [1, \\\n  2]\t# keep', eng.parser.src[0].script)
+    
+    def testinlinepython(self):
+        self.assertEqual('<p>a1b</p>\n', to_html('%p a@{1}b'))
+        self.assertEqual('<p>2}3</p>\n', to_html('%p @{ {1:2}[1] }}@{"3"}'))
+        self.assertEqual('<p>100% (1, 2)</p>\n', to_html('%p 100% @{1, 2}'))
+        self.assertEqual('<p>@{x}</p>\n', to_html('%p \\\\@{x}'))
+        self.assertEqual('<p>\\1</p>\n', to_html('%p \\\\\\@{1}'))
+        self.assertRaises(HamlException, partial(to_html, '%p @{1 # c}'))
+        eng.setops()
+        src = str(eng._parse('%p a@{x}b').src)
+        self.assertTrue("''.join(('a', unicode((x)), 'b'))" in src)
+    
     def testescapeattrs(self):
         self.assertEqual("<img title='foo&#39;s'>\n", to_html("%img{'title':'foo\\'s'}"))
         self.assertEqual("<img foo='bar&baz'>\n", to_html("%img{'foo':'bar&baz'}"))
@@ -225,9 +342,572 @@ class TestHaml(unittest.TestCase):
     def testillegalvalue(self):
         self.assertRaises(Exception, partial(to_html, '%p/ foo'))
     
+    def testerrortext(self):
+        for (s, line) in [('%p/ foo', '\n%p/ foo\n'), ('%p\n%b foo\n bar', '\n%b foo\n')]:
+            try:
+                to_html(s)
+            except HamlException:
+                self.assert_(line in str(sys.exc_info()[1]))
+            else:
+                self.fail()
+    
     def testraise(self):
         self.assertRaises(Exception, partial(to_html, '-raise Exception("")'))
     
+    def testhamllinenumbers(self):
+        eng.setops()
+        code = eng.compile('%p\n  foo\n%q\n  -for i in range(2):\n    %b= i', 'foo.haml')
+        self.assertEqual('foo.haml', code.co_filename)
+        try:
+            to_html('%p\n  foo\n%b= 1/0')
+        except HamlException:
+            self.assert_('File "<string>", line 3' in str(sys.exc_info()[1]))
+            self.assert_('%b= 1/0' in str(sys.exc_info()[1]))
+        else:
+            self.fail()
+    
+    def testlinemap(self):
+        eng.setops()
+        code = eng.compile('%p\n  foo\n-x = 1', 'linemap.haml')
+        self.assertEqual((3, '-x = 1'), eng.get_haml_line_info('linemap.haml', 9))
+        self.assertEqual(-1, eng.get_haml_line_info('linemap.haml', 100)[0])
+        self.assertEqual('-x = 1', eng.get_linemap(code).text(3))
+        del code
+        self.assertEqual(-1, eng.get_haml_line_info('linemap.haml', 9)[0])
+        #templates compiled from strings share a file name, so errors are
+        #mapped through the code that raised them
+        kept = [eng.compile('%p\n%p\n%p line3 kept\n- def f():\n  %a')]
+        for s in ('%p\n%p\n%p= 1/0', '- def f():\n  %p= 1/0\n- f()'):
+            try:
+                to_html(s)
+                self.fail()
+            except HamlException:
+                self.assert_('= 1/0' in str(sys.exc_info()[1]))
+                self.assertFalse('kept' in str(sys.exc_info()[1]))
+    
+    def testtracking(self):
+        to_html('%p\n  foo')
+        self.assertFalse(eng.parser.tracking)
+        self.assertRaises(HamlException, partial(to_html, '%p foo\n  bar'))
+        self.assert_(eng.parser.tracking)
+    
+    def testslots(self):
+        for cls in (HamlCall, Tag, LexToken):
+            self.assertFalse(hasattr(cls.__new__(cls), '__dict__'))
+    
+    def testlinelexer(self):
+        eng.setops()
+        for s in samples():
+            self.assertEqual(tokens(eng.lexer, s), tokens(LineLexer(), s))
+        s = '%p\n  %a{ "b": 1 } c\n:plain\n  d'
+        self.assertEqual(to_html(s), to_html(s, lexer='line'))
+    
+    def testlineparser(self):
+        for s in samples():
+            for format in ('html5', 'xhtml'):
+                self.assertEqual(source(s, format=format),
+                    source(s, format=format, parser='line'))
+        for s in ('-x', '%p\n  -x', ':foo\n foo'):
+            messages = []
+            for parser in ('ply', 'line'):
+                try:
+                    eng.setops(suppress_eval=True, parser=parser)
+                    eng.compile(s)
+                except HamlException:
+                    messages.append(str(sys.exc_info()[1]).split('\n')[:2])
+            self.assertEqual(2, len(messages))
+            self.assertEqual(messages[0], messages[1])
+        s = '%p\n  %a{ "b": 1 } c\n:plain\n  d'
+        self.assertEqual(to_html(s), to_html(s, parser='line', lexer='line'))
+    
+    def testpasses(self):
+        calls = [
+            HamlCall(func='write', args=['1'], depth=0),
+            HamlCall(func='entab', depth=0),
+            HamlCall(func='detab', depth=0),
+            HamlCall(func='write', args=['2'], depth=0),
+            HamlCall(func='write', args=['3'], depth=1),
+        ]
+        self.assertEqual(['write', 'write', 'write'],
+            [c.func for c in cancel_tabs(calls)])
+        merged = merge_writes(cancel_tabs(calls))
+        self.assertEqual([['1', '2'], ['3']], [c.args for c in merged])
+        #passes do not change the calls they are given
+        self.assertEqual(['1'], calls[0].args)
+        for s in ['%p\n  %a{ "b": 1 } c\n  -for i in range(2):\n    %b= i',
+                  '- x = 1\n  :plain']:
+            for profile in profiles:
+                self.assertEqual(to_html(s), to_html(s, optimize=profile))
+        eng.setops()
+        eng.compile(s)
+        self.assertEqual(sorted(required + profiles['default']),
+            sorted(eng.timings))
+
+    def testinline(self):
+        s = ("- def item(s, t):\n  %p{'a': t}= s.upper()\n"
+            "- for i in ['a', 'b']:\n  - item(i, 2)\n")
+        self.assertEqual(to_html(s), to_html(s, optimize='inline'))
+        calls = [str(c).strip() for c in inline_defs(eng._parse(s).src)]
+        self.assertEqual(1, len([c for c in calls if '(i).upper()' in c]))
+        self.assertFalse('item(i, 2)' in calls)
+        #calls inside functions, of rebound helpers or with arguments that
+        #could change between uses are left alone
+        for s in ['- def f(x):\n  %p= x\n- def g():\n  - f(1)\n- g()',
+                  '- def f(x):\n  %p= x\n- f = len\n- f(1)',
+                  '- def f(x):\n  %p= x\n- f(len([]))',
+                  '- def f(x):\n  - f(x)\n- f(1)']:
+            calls = eng._parse(s).src
+            self.assertEqual(map(str, calls), map(str, inline_defs(calls)))
+        #so are helpers defined again
+        for s in ['- def f(x):\n  %p= x\n- def f(x):\n  %b= x\n- f(1)',
+                  '- def f(x):\n  %p= x\n- if 1:\n  - def f(x):\n    %b= x\n- f(1)']:
+            self.assertEqual('<b>1</b>\n', to_html(s, optimize='inline'))
+        s = u'- def f(a):\n  %p= a\n- f(x)'
+        self.assertEqual('<p>1</p>\n', to_html(s, {'x': 1}, optimize='inline'))
+        calls = [str(c).strip() for c in inline_defs(eng._parse(s).src)]
+        self.assertFalse('f(x)' in calls)
+    
+    def testincremental(self):
+        templates = [s for s in corpus if '\n' in s] + [
+            '- if x:\n  %p a\n- else:\n  %p b\n%p c',
+            '- x = 1\n%p= x\n-@partial\n-def f():\n  = 2\n%p\n  - f()',
+            '%p a |\n  b |\n%a\n  %b',
+            #an illegal line with children, which nest under the line before
+            '%p ~ "a\\nb"\n..\n  = x + 1\n!= "<"',
+        ]
+        def html(s, **kwargs):
+            try:
+                return to_html(s, {'x': True, 'partial': partial}, **kwargs)
+            except HamlException:
+                return str(sys.exc_info()[1]).split('\n')[0]
+        for s in templates:
+            self.assertEqual(html(s), html(s, incremental=True))
+        self.assertTrue(html(templates[-1]).startswith('Parse error'))
+        s = '%p\n  %a\n\n%div\n  = 1 + 1\n%span'
+        eng.setops(incremental=True)
+        eng.compile(s, 'block.haml')
+        first = [code for code, _ in eng._blocks['block.haml'].values()]
+        code = eng.compile(s.replace('1 + 1', '2 + 2'), 'block.haml')
+        second = [code for code, _ in eng._blocks['block.haml'].values()]
+        #only the edited block is compiled again
+        self.assertEqual(2, len(set(first) & set(second)))
+        self.assertEqual(code.co_filename, 'block.haml')
+        eng.invalidate('block.haml')
+        self.assertFalse('block.haml' in eng._blocks)
+    
+    def testircache(self):
+        eng.setops()
+        calls = eng._calls('%p\n  %a{ "b": 1 } c\n  = 1 + 1', '<string>')
+        f = StringIO()
+        dump(calls, f, 'key')
+        f.seek(0)
+        loaded = load(f, 'key')
+        self.assertEqual([(str(c), c.haml.posinfo[0]) for c in calls],
+            [(str(c), c.haml.posinfo[0]) for c in loaded])
+        f.seek(0)
+        self.assertEqual(None, load(f, 'other key'))
+        self.assertEqual(None, load(StringIO('{"version": 0}\n'), 'key'))
+        #arguments of unicode templates may hold any character
+        f = StringIO()
+        dump([HamlCall(haml=calls[0].haml, func='write', args=[u'"\xe9"'],
+            depth=0)], f, 'key')
+        f.seek(0)
+        self.assertEqual(['"\xc3\xa9"'], load(f, 'key')[0].args)
+
+        p = os.path.join(dir, 'haml/func.haml')
+        html = render(p)
+        cache = tempfile.mkdtemp()
+        #the .pyc file comes before the intermediate code, so there must be none
+        pyc = Loader(eng, p).cache_path()
+        dont_write_bytecode = getattr(sys, 'dont_write_bytecode', False)
+        sys.dont_write_bytecode = True
+        try:
+            if os.path.exists(pyc):
+                os.remove(pyc)
+            eng._cache.cache.clear()
+            self.assertEqual(html, render(p, ir_cache=cache))
+            self.assert_(os.path.isfile(eng.ir_path(p)))
+            #the second compile reads the intermediate code instead of parsing
+            eng._cache.cache.clear()
+            eng._calls = None
+            try:
+                self.assertEqual(html, render(p, ir_cache=cache))
+            finally:
+                del eng._calls
+            #and a .pyc file is read instead of the intermediate code
+            Loader(eng, p).write_code(eng.cache(p))
+            eng._cache.cache.clear()
+            eng._compile_ir = None
+            try:
+                self.assertEqual(html, render(p, ir_cache=cache))
+            finally:
+                del eng._compile_ir
+            #every checkout of a template shares its intermediate code, named
+            #by the path relative to the loader's root or the search path
+            for (name, mtime) in (('a/page.haml', 1), ('b/page.haml', 2)):
+                self.write(name, '%p= 1 + 1', mtime)
+            a = Engine(FileSystemLoader(os.path.join(self.tmp, 'a')))
+            self.assertEqual('<p>2</p>\n',
+                a.render('page.haml', ir_cache=cache))
+            self.assertEqual(os.path.join(cache, 'page.haml.hamlir'),
+                a.ir_path('page.haml'))
+            b = Engine()
+            b._calls = None
+            root = os.path.join(self.tmp, 'b')
+            self.assertEqual('<p>2</p>\n', b.render(os.path.join(root,
+                'page.haml'), ir_cache=cache, search_path=root))
+            #func.haml's and page.haml's
+            self.assertEqual(2, len(os.listdir(cache)))
+        finally:
+            sys.dont_write_bytecode = dont_write_bytecode
+            eng._cache.cache.clear()
+            shutil.rmtree(cache)
+    
+    def testdiagnostics(self):
+        self.assertEqual('<p></p>\n<a></a>\n', to_html('%p\n.. &&!\n%a'))
+        #the line is left empty, so the parser finds a syntax error after it
+        self.assertEqual([(2, 3, '.. &&!'), (2, 9, '\n')],
+            [(d.lineno, d.lexpos, d.text) for d in eng.diagnostics])
+        #a long run of illegal characters is one diagnostic
+        to_html('%p\n' + '&' * 20000, lexer='line')
+        self.assertEqual(1, len(eng.diagnostics))
+        try:
+            to_html('%p\n..', fail_fast=True)
+            self.fail()
+        except HamlException, ex:
+            self.assert_('Illegal character(s) [..]' in str(ex))
+    
+    def testengines(self):
+        strict = Engine()
+        strict.setops(fail_fast=True)
+        lenient = Engine()
+        lenient.setops()
+        self.assertRaises(HamlException, partial(strict.compile, '%p\n..'))
+        lenient.compile('%p\n..')
+        self.assertEqual(1, len(lenient.diagnostics))
+        self.assertEqual([], strict.diagnostics)
+        #the tables are shared, the state of a parse is not
+        self.assert_(strict.parser.action is lenient.parser.action)
+        self.assert_(strict.lexer.lexre is lenient.lexer.lexre)
+        self.assert_(strict.lexer is not lenient.lexer)
+    
+    def testimportcache(self):
+        lib = self.write('helpers.haml', '- def foo():\n  %a= bar')
+        self.write('out.haml', '- runs.append(2)\n%b')
+        self.write('args.haml', '- y = bar * 2\n- def twice():\n  %i= y')
+        page = self.write('page.haml', "- mods.append(_haml.imp('helpers'))\n"
+            "- mods[-1].foo()\n- _haml.imp('out')\n- _haml.imp('args').twice()")
+        try:
+            (runs, mods) = ([], [])
+            for bar in ('x', 'y'):
+                self.assertEqual('<a>%s</a>\n<b></b>\n<i>%s</i>\n' %
+                    (bar, bar * 2),
+                    render(page, {'runs': runs, 'mods': mods, 'bar': bar}))
+            #helpers only defines a function and is run once, while out writes
+            #HTML and args reads an argument, so they are run every time
+            self.assert_(mods[0] is mods[1])
+            self.assertEqual([2, 2], runs)
+            #a reused module only sees the arguments of the current render
+            self.assertRaises(HamlException, render, page,
+                {'runs': runs, 'mods': mods})
+            self.assertFalse('bar' in mods[2].__dict__)
+            del mods[2:]
+            mtime = os.path.getmtime(lib)
+            os.utime(lib, (mtime + 10, mtime + 10))
+            render(page, {'runs': runs, 'mods': mods, 'bar': 'x'})
+            self.assert_(mods[2] is not mods[1])
+            eng.invalidate(lib)
+            render(page, {'runs': runs, 'mods': mods, 'bar': 'x'})
+            self.assert_(mods[3] is not mods[2])
+        finally:
+            eng.invalidate()
+    
+    def testimportthreads(self):
+        #each engine's imports are found in its own directory, even while
+        #another engine renders in another thread
+        a = self.write('a/page.haml', '- started.set()\n- go.wait()\n'
+            '- import tenant\n= tenant.name')
+        b = self.write('b/page.haml', '- import tenant\n= tenant.name')
+        self.write('a/tenant.haml', "- name = 'a'")
+        self.write('b/tenant.haml', "- name = 'b'")
+        (started, go) = (threading.Event(), threading.Event())
+        results = {}
+        def render_a():
+            results['a'] = Engine().render(a, {'started': started, 'go': go})
+        thread = threading.Thread(target=render_a)
+        thread.start()
+        started.wait()
+        try:
+            results['b'] = Engine().render(b)
+        finally:
+            go.set()
+            thread.join()
+        self.assertEqual({'a': 'a\n', 'b': 'b\n'}, results)
+    
+    def testpycache(self):
+        tmp = tempfile.mkdtemp()
+        dont_write_bytecode = getattr(sys, 'dont_write_bytecode', False)
+        sys.dont_write_bytecode = False
+        try:
+            path = os.path.join(tmp, 'pyc_lib.haml')
+            with open(path, 'w') as f:
+                f.write('- def foo():\n  %a= bar')
+            page = os.path.join(tmp, 'page.haml')
+            with open(page, 'w') as f:
+                f.write('- import pyc_lib\n- pyc_lib.foo()')
+            #the import statement finds Haml files while a template renders
+            self.assertEqual('<a>x</a>\n', render(page, {'bar': 'x'}))
+            self.assertEqual([finder],
+                [f for f in sys.meta_path if isinstance(f, Finder)])
+            self.assertEqual(None, finder.find_module('pyc_lib'))
+            pyc = Loader(eng, path).cache_path()
+            self.assert_(os.path.isfile(pyc))
+            #another engine reads the code back instead of compiling it
+            other = Engine()
+            other.setops()
+            other.compile = None
+            code = Loader(other, path).get_code('pyc_lib')
+            self.assertEqual(eng.cache(path).co_code, code.co_code)
+            self.assertEqual(path, code.co_filename)
+        finally:
+            sys.dont_write_bytecode = dont_write_bytecode
+            eng.invalidate()
+            shutil.rmtree(tmp)
+    
+    def testsearchpath(self):
+        self.write('a/x.haml', '- def x():\n  %a')
+        self.write('b/x.haml', '- def x():\n  %b')
+        self.write('b/sub/y.haml', '- def y():\n  %i')
+        page = self.write('page.haml',
+            "- _haml.imp('//x').x()\n- _haml.imp('sub/y').y()")
+        search_path = os.pathsep.join(
+            [os.path.join(self.tmp, 'a'), os.path.join(self.tmp, 'b')])
+        try:
+            self.assertEqual('<a></a>\n<i></i>\n',
+                render(page, search_path=search_path))
+        finally:
+            eng.invalidate()
+        
+        now = [0]
+        index = TemplateIndex(clock=lambda: now[0])
+        self.assertEqual(None, index.find((self.tmp,), 'z', 10))
+        z = self.write('z.haml', '%p')
+        #misses are remembered until the index is too old
+        self.assertEqual(None, index.find((self.tmp,), 'z', 10))
+        now[0] = 11
+        self.assertEqual(z, index.find((self.tmp,), 'z', 10))
+    
+    def testdependencies(self):
+        base = self.write('dep_base.haml', '- def helper():\n  %a')
+        lib = self.write('dep_lib.haml', "- base = _haml.imp('dep_base')\n"
+            "- def foo():\n  - base.helper()")
+        page = self.write('page.haml', '- import dep_lib\n- dep_lib.foo()')
+        try:
+            self.assertEqual('<a></a>\n', render(page))
+            self.assertEqual(set([lib]), eng.dependencies(page))
+            self.assertEqual(set([lib, page]), eng.dependents(base))
+            #dep_lib did not change, but it holds on to dep_base, so it is run
+            #again as well
+            self.write('dep_base.haml', '- def helper():\n  %b',
+                os.path.getmtime(base) + 10)
+            self.assertEqual('<b></b>\n', render(page))
+            eng.invalidate(base)
+            self.assertFalse(lib in eng._cache.cache)
+            self.assertFalse(page in eng._cache.cache)
+        finally:
+            eng.invalidate()
+    
+    def testloaders(self):
+        templates = {
+            'page.haml': "- _haml.imp('parts/loader_part').part()",
+            'parts/loader_part.haml': '- def part():\n  %a',
+        }
+        memory = Engine(DictLoader(templates))
+        self.assertEqual('<a></a>\n', memory.render('page.haml'))
+        #a changed source changes the fingerprint, which invalidates the
+        #code of every template importing it
+        templates['parts/loader_part.haml'] = '- def part():\n  %b'
+        self.assertEqual('<b></b>\n', memory.render('page.haml'))
+        self.assertRaises(IOError, memory.render, 'missing.haml')
+        
+        tmp = tempfile.mkdtemp()
+        try:
+            archive = os.path.join(tmp, 'templates.zip')
+            with closing(zipfile.ZipFile(archive, 'w')) as z:
+                for (name, s) in templates.items():
+                    z.writestr('pkg/templates/' + name, s)
+            zipped = Engine(ZipLoader(archive, 'pkg/templates'))
+            self.assertEqual('<b></b>\n', zipped.render('page.haml'))
+            self.assertEqual(['loader_part.haml'],
+                zipped.loader.listdir('parts'))
+        finally:
+            shutil.rmtree(tmp)
+        
+        #names are relative to the root of a FileSystemLoader
+        self.write('fs/root.haml', '%p', 100)
+        self.write('fs/parts/part.haml', '%a')
+        loader = FileSystemLoader(os.path.join(self.tmp, 'fs'))
+        self.assertEqual('%p', loader.get_source('root.haml'))
+        self.assertEqual('%a', loader.get_source('parts/part.haml'))
+        self.assertRaises(IOError, loader.get_source, 'missing.haml')
+        self.assertEqual((100, 2), loader.fingerprint('root.haml'))
+        self.assertEqual(None, loader.fingerprint('missing.haml'))
+        self.assertEqual(['parts', 'root.haml'], sorted(loader.listdir('')))
+        self.assertEqual(['part.haml'], loader.listdir('parts'))
+        self.assertEqual([], loader.listdir('missing'))
+        
+        #a failed write leaves the file as it was, and no temporary file
+        path = self.write('out/atomic.txt', 'old')
+        def fail():
+            with atomic_write(path) as f:
+                f.write('new')
+                raise IOError('disk full')
+        self.assertRaises(IOError, fail)
+        self.assertEqual(['atomic.txt'], os.listdir(os.path.dirname(path)))
+        with open(path) as f:
+            self.assertEqual('old', f.read())
+        with atomic_write(path, 'w') as f:
+            f.write('new')
+        with open(path) as f:
+            self.assertEqual('new', f.read())
+    
+    def testbundle(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            root = os.path.join(tmp, 'templates')
+            os.makedirs(os.path.join(root, 'parts'))
+            with open(os.path.join(root, 'page.haml'), 'w') as f:
+                f.write("- _haml.imp('parts/bundle_part').part()\n%p= x")
+            with open(os.path.join(root, 'parts', 'bundle_part.haml'), 'w') as f:
+                f.write('- def part():\n  %a')
+            path = os.path.join(tmp, 'templates.hamlb')
+            builder = Engine(FileSystemLoader(root))
+            builder.setops()
+            self.assertEqual(['page.haml', 'parts/bundle_part.haml'],
+                templates(root))
+            build(builder, templates(root), path)
+            #rendering needs nothing but the bundle
+            shutil.rmtree(root)
+            bundled = Engine(Bundle(path))
+            self.assertEqual('<a></a>\n<p>1</p>\n',
+                bundled.render('page.haml', {'x': 1}))
+            self.assertEqual(set(['parts/bundle_part.haml']),
+                bundled.dependencies('page.haml'))
+            self.assertRaises(IOError, Engine(Bundle(path)).render,
+                'page.haml', {'x': 1}, format='xhtml')
+        finally:
+            shutil.rmtree(tmp)
+    
+    def testmoduleregistry(self):
+        templates = {
+            'page.haml': "- import reg_a\n- reg_a.f()\n- _haml.imp('reg_b').g()",
+            'reg_a.haml': "- import reg_b\n- def f():\n  %a",
+            'reg_b.haml': "- def g():\n  %b",
+        }
+        engine = Engine(DictLoader(templates), max_modules=1)
+        self.assertEqual('<a></a>\n<b></b>\n', engine.render('page.haml'))
+        self.assertFalse('reg_a' in sys.modules)
+        #only the most recently used module is held on to, and the other
+        #one is reclaimed once the render's globals let go of it
+        self.assertEqual(['reg_b.haml'], list(engine._modules.order))
+        engine.reset()
+        gc.collect()
+        self.assertEqual(1, len(engine._modules))
+        self.assertEqual('<a></a>\n<b></b>\n', engine.render('page.haml'))
+        #modules hold on to the modules they import, whose functions they use
+        templates = {
+            'page.haml': "- import evict_a\n- import evict_c\n- evict_a.f()\n"
+                "- evict_c.h()",
+            'evict_a.haml': "- from evict_b import g\n- def f():\n  - g()",
+            'evict_b.haml': "- def g():\n  %b",
+            'evict_c.haml': "- def h():\n  %i",
+        }
+        engine = Engine(DictLoader(templates), max_modules=2)
+        for i in range(2):
+            self.assertEqual('<b></b>\n<i></i>\n', engine.render('page.haml'))
+            gc.collect()
+    
+    def testlink(self):
+        templates = {
+            'page.haml': "- lib = _haml.imp('link_lib')\n- lib.wrap(x)",
+            'link_lib.haml': "- base = _haml.imp('link_base')\n"
+                "- def wrap(s):\n  %p= base.em(s)",
+            'link_base.haml': "- def em(s):\n  - return '<em>%s</em>' % s",
+        }
+        html = Engine(DictLoader(templates)).render('page.haml', {'x': 1})
+        engine = Engine(DictLoader(templates))
+        self.assertEqual(html, engine.render('page.haml', {'x': 1}, link=True))
+        #the imported files are found and compiled with the page
+        def find_module(*args):
+            raise ImportError
+        engine.find_module = find_module
+        self.assertEqual(html, engine.render('page.haml', {'x': 1}, link=True))
+        del engine.find_module
+        #calls spelled out in strings are left alone
+        templates['quoted.haml'] = "%p= \"_haml.imp('link_lib')\""
+        self.assertEqual('<p>_haml.imp(\'link_lib\')</p>\n',
+            engine.render('quoted.haml', link=True))
+        templates['link_base.haml'] = "- def em(s):\n  - return s"
+        self.assertEqual('<p>1</p>\n',
+            engine.render('page.haml', {'x': 1}, link=True))
+    
+    def testbatch(self):
+        compile_file = batch.compile_file
+        try:
+            self.write('page.haml', '%p')
+            self.write('sub/part.haml', '- def part():\n  %a')
+            self.write('bad.haml', '%p{')
+            tmp = self.tmp
+            paths = batch.templates([tmp])
+            self.assertEqual(3, len(paths))
+            errors = batch.run(paths, {}, jobs=2)
+            self.assertEqual([os.path.join(tmp, 'bad.haml')],
+                [path for (path, error) in errors])
+            self.assertTrue(batch.report(errors).startswith('1 haml file'))
+            self.assertTrue(os.path.isfile(
+                os.path.join(tmp, 'sub', '__pycache__', 'part.haml.pyc')))
+            self.assertTrue(os.path.isfile(
+                os.path.join(tmp, '__pycache__', 'haml-manifest.json')))
+            #any exception fails only its own file
+            strict = self.write('crash/strict.haml', '!!! strict')
+            ok = self.write('crash/ok.haml', '%p')
+            errors = batch.run([strict, ok], {}, jobs=1)
+            self.assertEqual([strict], [path for (path, error) in errors])
+            self.assertTrue('KeyError' in errors[0][1])
+            manifest = batch.load_manifest(batch.default_manifest([ok]))
+            self.assertEqual([os.path.abspath(ok)], list(manifest))
+            #rendering takes the compiled code of the page too
+            fresh = Engine()
+            fresh.compile = None
+            self.assertEqual('<p></p>\n',
+                fresh.render(os.path.join(tmp, 'page.haml')))
+            #only the files that failed or changed are compiled again
+            compiled = []
+            def spy(args):
+                compiled.append(args[0])
+                return compile_file(args)
+            batch.compile_file = spy
+            self.write('bad.haml', '%p')
+            self.assertEqual([], batch.run(paths, {}, jobs=1))
+            self.assertEqual([os.path.join(tmp, 'bad.haml')], compiled)
+            del compiled[:]
+            self.assertEqual([], batch.run(paths, {'format': 'xhtml'},
+                jobs=1))
+            self.assertEqual(3, len(compiled))
+            #a file is compiled again when a file linked into it changes
+            base = self.write('link/base.haml', "- def word():\n  - return 'a'")
+            lib = self.write('link/lib.haml',
+                "- base = _haml.imp('base')\n%p= base.word()")
+            self.assertEqual([], batch.run([lib], {'link': True}, jobs=1))
+            self.write('link/base.haml', "- def word():\n  - return 'b'",
+                os.path.getmtime(base) + 10)
+            self.assertEqual('<p>b</p>\n', Engine().render(lib, link=True))
+            del compiled[:]
+            self.assertEqual([], batch.run([lib], {'link': True}, jobs=1))
+            self.assertEqual([lib], compiled)
+        finally:
+            batch.compile_file = compile_file
+    
     def testindentation(self):
         self.assertRaises(Exception, partial(to_html, '%p\n\t %p'))
         self.assertRaises(Exception, partial(to_html, '%p\n %p\n    %p'))